@@ -4,19 +4,33 @@
 Simple analysis tasks for s3tr JSON results
 """
 
+import collections
 import csv
-import json
 import logging
 import pathlib
+import statistics
 import sys
 
 import click
+import profiling
+import results as s3tr_results
 import rich
+from history import percentile
 from rich.console import Console
 from rich.table import Table
 
 LOG = logging.getLogger("s3tr")
 
+# Resource usage keys of results and their display scale and unit
+RESOURCES = {
+    "cpu_ns": (10**9, "CPU s"),
+    "mem_peak_bytes": (2**20, "Peak memory MiB"),
+    "io_read_bytes": (2**20, "Read MiB"),
+    "io_write_bytes": (2**20, "Written MiB"),
+}
+
+PHASES = ("container_start", "ready", "users", "idle", "pytest", "logs", "teardown")
+
 
 @click.group()
 def analyze():
@@ -62,10 +76,10 @@ def summary(file, excuses_file):
     else:
         excuses = None
 
-    with open(file) as fp:
-        results = json.load(fp)
-
-    results = {result["test"].split("::")[1]: result for result in results}
+    results = {
+        result["test"].split("::")[1]: result
+        for result in s3tr_results.read_results(file, blobs=False)
+    }
     failures = frozenset(
         (name for name, result in results.items() if result["test_return"] != "success")
     )
@@ -79,6 +93,12 @@ def summary(file, excuses_file):
     table.add_row("Failed tests", str(len(failures)))
     table.add_row("Successful tests", str(len(successes)))
     table.add_row("Total tests", str(len(results)))
+    if any(result.get("io_bound") is not None for result in results.values()):
+        io_bound = sum(bool(result.get("io_bound")) for result in results.values())
+        table.add_row("I/O bound tests", str(io_bound))
+    flaky = frozenset(name for name, result in results.items() if result.get("flaky"))
+    if flaky:
+        table.add_row("Flaky tests (succeeded on retry)", str(len(flaky)))
     if excuses:
         table.add_row("Tests OK to fail", str(len(excuses)))
 
@@ -86,7 +106,8 @@ def summary(file, excuses_file):
         sys.exit(0)
 
     failures_that_must_not_be = failures - excuses.keys()
-    new_successes = excuses.keys() & successes
+    # A flaky excused test that happened to succeed stays excused
+    new_successes = (excuses.keys() & successes) - flaky
     table.add_row("Failures, not excused", str(len(failures_that_must_not_be)))
     table.add_row("Successes, excused", str(len(new_successes)))
     console.print(table)
@@ -129,19 +150,19 @@ def summary(file, excuses_file):
         console.print("🥳")
 
 
-def get_result(file, test_name):
-    with open(file) as fp:
-        results = json.load(fp)
-    return next(result for result in results if test_name in result["test"])
+def get_result(file, test_name, key):
+    result = s3tr_results.find_result(file, test_name, keys=(key,))
+    if not result:
+        LOG.critical(f"No result for {test_name} in {file}")
+        sys.exit(2)
+    return result
 
 
 def print_result(file, test_name, key):
-    result = get_result(file, test_name)
-    LOG.info(
-        f"Test {result['test']} result "
-        f"{result['test_return']} / {result['test_data']['outcome']}"
-    )
-    print(get_result(file, test_name)[key])
+    result = get_result(file, test_name, key)
+    outcome = (result["test_data"] or {}).get("outcome")
+    LOG.info(f"Test {result['test']} result {result['test_return']} / {outcome}")
+    print(result[key])
 
 
 @analyze.command()
@@ -186,3 +207,265 @@ def test_out(file, test_name):
     What to add to s3-tests.txt?
     """
     print_result(file, test_name, "test_output")
+
+
+def get_samples(result, phase):
+    """Runtimes in ns of all runs of a result. phase None for runtime_ns"""
+    runs = result.get("repeats") or [result]
+    if phase is None:
+        return [run["runtime_ns"] for run in runs if run.get("runtime_ns")]
+    return [
+        run["phases_ns"][phase] for run in runs if phase in (run.get("phases_ns") or {})
+    ]
+
+
+@analyze.command()
+@click.argument(
+    "file",
+    type=click.Path(
+        file_okay=True, dir_okay=False, allow_dash=False, path_type=pathlib.Path
+    ),
+    required=True,
+    nargs=1,
+)
+@click.option(
+    "--phase",
+    type=click.Choice(PHASES),
+    default=None,
+    help="Report a phase instead of the test runtime",
+)
+def benchmark(file, phase):
+    """
+    Runtime distribution per test of a run with --repeat
+    """
+    rows = []
+    for result in s3tr_results.read_results(file, blobs=False):
+        samples = get_samples(result, phase)
+        if not samples:
+            continue
+        mean = statistics.mean(samples)
+        cv = statistics.stdev(samples) / mean if len(samples) > 1 and mean else 0.0
+        failed = sum(
+            run["test_return"] != "success" for run in result.get("repeats") or [result]
+        )
+        rows.append(
+            (
+                result["test"].split("::")[-1],
+                len(samples),
+                failed,
+                statistics.median(samples),
+                percentile(samples, 95),
+                cv,
+            )
+        )
+
+    table = Table(
+        box=rich.box.SIMPLE,
+        title=f"S3 Test Benchmark - {phase or 'runtime'}",
+    )
+    table.add_column("Test Name")
+    table.add_column("Runs", justify="right")
+    table.add_column("Failed", justify="right")
+    table.add_column("Median (s)", justify="right")
+    table.add_column("p95 (s)", justify="right")
+    table.add_column("CV", justify="right")
+    for name, runs, failed, median, p95, cv in sorted(
+        rows, key=lambda row: row[3], reverse=True
+    ):
+        table.add_row(
+            name,
+            str(runs),
+            str(failed),
+            f"{median / 10**9:.3f}",
+            f"{p95 / 10**9:.3f}",
+            f"{cv:.1%}",
+        )
+    Console().print(table, soft_wrap=True)
+
+
+def get_resources(file):
+    return {
+        result["test"].split("::")[-1]: result
+        for result in s3tr_results.read_results(file, blobs=False)
+        if any(result.get(key) is not None for key in RESOURCES)
+    }
+
+
+def format_resource(result, key):
+    value = result.get(key) if result else None
+    if value is None:
+        return "-"
+    scale, _ = RESOURCES[key]
+    return f"{value / scale:.1f}"
+
+
+@analyze.command()
+@click.argument(
+    "file",
+    type=click.Path(
+        file_okay=True, dir_okay=False, allow_dash=False, path_type=pathlib.Path
+    ),
+    required=True,
+    nargs=1,
+)
+@click.argument(
+    "baseline-file",
+    type=click.Path(
+        file_okay=True, dir_okay=False, allow_dash=False, path_type=pathlib.Path
+    ),
+    required=False,
+    nargs=1,
+)
+@click.option(
+    "--sort",
+    "sort_key",
+    type=click.Choice(tuple(RESOURCES)),
+    default="cpu_ns",
+    help="Resource to rank tests by",
+)
+@click.option("--top", type=int, default=20, help="Number of tests to show")
+def resources(file, baseline_file, sort_key, top):
+    """
+    Tests using the most CPU, memory or disk I/O. With BASELINE_FILE,
+    e.g results of the previous version, tests with the largest increase
+    """
+    results = get_resources(file)
+    baseline = get_resources(baseline_file) if baseline_file else {}
+
+    def rank(item):
+        name, result = item
+        value = result.get(sort_key) or 0
+        if not baseline_file:
+            return value
+        base_value = (baseline.get(name) or {}).get(sort_key)
+        return value / base_value if base_value else 0
+
+    table = Table(
+        box=rich.box.SIMPLE,
+        title=(
+            f"Largest {RESOURCES[sort_key][1]} increase vs. {baseline_file}"
+            if baseline_file
+            else f"Top {RESOURCES[sort_key][1]}"
+        ),
+    )
+    table.add_column("Test Name")
+    if baseline_file:
+        table.add_column(RESOURCES[sort_key][1], justify="right")
+        table.add_column("Baseline", justify="right")
+        table.add_column("Change", justify="right")
+    else:
+        for _, unit in RESOURCES.values():
+            table.add_column(unit, justify="right")
+    for name, result in sorted(results.items(), key=rank, reverse=True)[:top]:
+        if baseline_file:
+            ratio = rank((name, result))
+            table.add_row(
+                name,
+                format_resource(result, sort_key),
+                format_resource(baseline.get(name), sort_key),
+                f"{ratio - 1:+.0%}" if ratio else "-",
+            )
+        else:
+            table.add_row(name, *(format_resource(result, key) for key in RESOURCES))
+    Console().print(table, soft_wrap=True)
+
+
+def get_flakiness(returns):
+    """0 if all attempts had the same outcome, 1 if half succeeded"""
+    failed = sum(ret != "success" for ret in returns)
+    return 2 * min(failed, len(returns) - failed) / len(returns)
+
+
+@analyze.command()
+@click.argument(
+    "files",
+    type=click.Path(
+        file_okay=True, dir_okay=False, allow_dash=False, path_type=pathlib.Path
+    ),
+    required=True,
+    nargs=-1,
+)
+@click.option("--top", type=int, default=20, help="Number of tests to show")
+def flaky(files, top):
+    """
+    Tests with the most unstable outcomes over all attempts, including
+    retries, in FILES. E.g results of several runs of the same version
+    """
+    returns = collections.defaultdict(list)
+    for file in files:
+        for result in s3tr_results.read_results(file, blobs=False):
+            returns[result["test"].split("::")[-1]].extend(
+                s3tr_results.get_attempt_returns(result)
+            )
+    rows = sorted(
+        (
+            (get_flakiness(test_returns), name, test_returns)
+            for name, test_returns in returns.items()
+        ),
+        reverse=True,
+    )
+    table = Table(box=rich.box.SIMPLE, title=f"Flaky tests in {len(files)} runs")
+    table.add_column("Test Name")
+    table.add_column("Attempts", justify="right")
+    table.add_column("Failed", justify="right")
+    table.add_column("Flakiness", justify="right")
+    for flakiness, name, test_returns in rows[:top]:
+        if not flakiness:
+            break
+        table.add_row(
+            name,
+            str(len(test_returns)),
+            str(sum(ret != "success" for ret in test_returns)),
+            f"{flakiness:.2f}",
+        )
+    Console().print(table, soft_wrap=True)
+
+
+@analyze.command()
+@click.argument(
+    "file",
+    type=click.Path(
+        file_okay=True, dir_okay=False, allow_dash=False, path_type=pathlib.Path
+    ),
+    required=True,
+    nargs=1,
+)
+@click.option(
+    "--tests",
+    "test_patterns",
+    multiple=True,
+    help="Only merge profiles of tests with names containing this string",
+)
+@click.option(
+    "--svg",
+    type=click.Path(
+        file_okay=True, dir_okay=False, allow_dash=False, path_type=pathlib.Path
+    ),
+    help="Write a flame graph SVG instead of printing folded stacks",
+)
+def flamegraph(file, test_patterns, svg):
+    """
+    Merge radosgw profiles of a run with --profile into one flame graph
+    """
+    counts = collections.Counter()
+    merged = set()
+    for result in s3tr_results.read_results(file, blobs=False):
+        profile = result.get("profile")
+        if not profile or (
+            test_patterns
+            and not any(pattern in result["test"] for pattern in test_patterns)
+        ):
+            continue
+        # Tests of a batch share their profile
+        key = profile["$file"] if s3tr_results.is_blob_ref(profile) else profile
+        if key in merged:
+            continue
+        merged.add(key)
+        counts.update(profiling.parse_folded(s3tr_results.load_blob(file, profile)))
+
+    LOG.info(f"Merged {len(merged)} profiles, {sum(counts.values())} samples")
+    if svg:
+        with open(svg, "w") as fp:
+            fp.write(profiling.render_svg(counts, f"radosgw - {file.name}"))
+    else:
+        sys.stdout.write(profiling.format_folded(counts))
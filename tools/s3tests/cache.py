@@ -0,0 +1,104 @@
+#!/usr/bin/env python3
+"""
+Content addressed cache of s3tr results
+
+A result is stored under a key derived from everything that decides
+its outcome: s3gw image ID, test node ID, the s3-tests sources and
+configuration and the radosgw and container configuration. Only
+successful results are stored. Entries are gzip compressed JSON with
+side files inlined, so they do not depend on the results file they
+came from.
+"""
+
+import gzip
+import hashlib
+import json
+import logging
+import os
+import pathlib
+
+LOG = logging.getLogger("s3tr")
+
+# Suffixes of s3-tests files that decide test outcomes, besides
+# requirements*.txt
+SOURCE_SUFFIXES = (".py", ".ini", ".cfg", ".toml")
+
+
+def is_source(name):
+    return name.endswith(SOURCE_SUFFIXES) or (
+        name.startswith("requirements") and name.endswith(".txt")
+    )
+
+
+def hash_tree(root):
+    """
+    SHA-256 over the paths and contents of the source files below root.
+    Skips hidden directories, __pycache__ and virtualenvs
+    """
+    digest = hashlib.sha256()
+    for dirpath, dirnames, filenames in os.walk(root):
+        dirnames[:] = sorted(
+            name
+            for name in dirnames
+            if not name.startswith(".")
+            and name != "__pycache__"
+            and not os.path.exists(os.path.join(dirpath, name, "pyvenv.cfg"))
+        )
+        for name in sorted(filter(is_source, filenames)):
+            path = os.path.join(dirpath, name)
+            digest.update(os.path.relpath(path, root).encode("utf-8") + b"\0")
+            with open(path, "rb") as fp:
+                digest.update(hashlib.sha256(fp.read()).digest())
+    return digest.hexdigest()
+
+
+class ResultCache:
+    """
+    Successful results in path, keyed by key(). image_id, the hash of
+    the s3-tests tree and container_args are part of every key
+    """
+
+    def __init__(self, path, s3_tests, image_id, container_args):
+        self.path = pathlib.Path(path)
+        self.image_id = image_id
+        self.s3_tests_hash = hash_tree(s3_tests)
+        self.container_args = json.dumps(container_args, sort_keys=True)
+        self.path.mkdir(parents=True, exist_ok=True)
+
+    def key(self, name, config):
+        """
+        Cache key of test name. config describes how its container is
+        set up, e.g the radosgw command line
+        """
+        fields = {
+            "image_id": self.image_id,
+            "test": name,
+            "s3_tests": self.s3_tests_hash,
+            "config": config,
+            "container_args": self.container_args,
+        }
+        return hashlib.sha256(
+            json.dumps(fields, sort_keys=True).encode("utf-8")
+        ).hexdigest()
+
+    def entry_path(self, key):
+        return self.path / key[:2] / f"{key}.json.gz"
+
+    def get(self, key):
+        try:
+            with gzip.open(self.entry_path(key), "rt") as fp:
+                return json.load(fp)
+        except FileNotFoundError:
+            return None
+        except (OSError, json.JSONDecodeError) as e:
+            LOG.warning(f"Ignoring broken cache entry {key}: {e}")
+            return None
+
+    def put(self, key, result):
+        """Store result. Blobs must be loaded"""
+        path = self.entry_path(key)
+        path.parent.mkdir(exist_ok=True)
+        tmp_path = path.with_name(f"{path.name}.{os.getpid()}.tmp")
+        with gzip.open(tmp_path, "wt", compresslevel=1) as fp:
+            json.dump(result, fp)
+        os.replace(tmp_path, path)
@@ -0,0 +1,152 @@
+#!/usr/bin/env python3
+"""
+Classify radosgw container logs by crash type and extract crash
+signatures. Markers are found with plain substring searches, detail
+regexes only run on the lines around them
+"""
+
+import os
+import re
+
+# Crash kinds in order of precedence. A segfault while handling an
+# assertion is reported as segfault
+CRASH_KINDS = ("segfault", "assertion", "unhandled exception", "crash")
+
+# Marker substring of each crash kind
+CRASH_MARKERS = {
+    "segfault": "Segmentation fault",
+    "assertion": "FAILED ceph_assert(",
+    "unhandled exception": "BUG Unhandled exception",
+    "crash": "end dump of recent events",
+}
+
+# Start of a backtrace. Also found in the startup banner, which has no
+# frames following
+BACKTRACE_MARKER = " ceph version "
+
+# Line of the assertion marker. Condition up to the last parenthesis
+ASSERTION_RE = re.compile(r"FAILED ceph_assert\((?P<condition>.*)\)")
+
+# " ceph version 17.2.0 (...)" followed by " 1: ..." frame lines
+BACKTRACE_RE = re.compile(r" ceph version [^\n]*\n(?P<frames>(?: *\d+: [^\n]*\n)+)")
+
+# "/src/rgw/rgw_sal_sfs.cc: 123: FAILED ceph_assert(...)"
+ASSERT_LOCATION_RE = re.compile(r"(?P<file>\S+): (?P<line>\d+): $")
+
+# " 5: (rgw::sal::SFStore::foo()+0x2a) [0x55d1c0e1b2a4]"
+FRAME_RE = re.compile(
+    r" *\d+: (?:\((?P<symbol>.+)\+0x[0-9a-f]+\)|(?P<raw>.*?))(?: \[0x[0-9a-f]+\])?$"
+)
+
+# Frames of signal handling and assertion machinery, not the cause
+IGNORED_FRAME_PATTERNS = (
+    "libc.so",
+    "libpthread.so",
+    "__restore_rt",
+    "gsignal",
+    "raise",
+    "abort",
+    "__ceph_assert_fail",
+    "ceph_abort",
+    "handle_oneshot_fatal_signal",
+    "handle_fatal_signal",
+)
+
+
+def get_crash_frame(frames):
+    """
+    First backtrace frame that is not part of crash handling. Prefer
+    frames with symbols
+    """
+    raw_frame = None
+    for line in frames.splitlines():
+        match = FRAME_RE.match(line)
+        if not match:
+            continue
+        frame = match.group("symbol") or match.group("raw")
+        if not frame or any(pattern in frame for pattern in IGNORED_FRAME_PATTERNS):
+            continue
+        if match.group("symbol"):
+            return frame.strip()
+        raw_frame = raw_frame or frame.strip()
+    return raw_frame
+
+
+def find_lines(log, marker):
+    """Iterate over the lines of log containing marker"""
+    pos = log.find(marker)
+    while pos >= 0:
+        line_start = log.rfind("\n", 0, pos) + 1
+        line_end = log.find("\n", pos)
+        if line_end < 0:
+            line_end = len(log)
+        yield log[line_start:line_end]
+        pos = log.find(marker, line_end)
+
+
+def find_backtrace_frames(log):
+    """Frames of the first backtrace in log, None if there is none"""
+    pos = log.find(BACKTRACE_MARKER)
+    while pos >= 0:
+        match = BACKTRACE_RE.match(log, pos)
+        if match:
+            return match.group("frames")
+        pos = log.find(BACKTRACE_MARKER, pos + 1)
+    return None
+
+
+def classify_log(log):
+    """
+    Return dict of crash (kind or None), crash_signature, crash_frame,
+    assert_location, assert_condition and exception
+    """
+    result = {
+        "crash": None,
+        "crash_signature": None,
+        "crash_frame": None,
+        "assert_location": None,
+        "assert_condition": None,
+        "exception": None,
+    }
+    found = set()
+    for line in find_lines(log, CRASH_MARKERS["assertion"]):
+        match = ASSERTION_RE.search(line)
+        if match:
+            found.add("assertion")
+            location = ASSERT_LOCATION_RE.search(line, 0, match.start())
+            if location:
+                result["assert_location"] = (
+                    f"{os.path.basename(location.group('file'))}:"
+                    f"{location.group('line')}"
+                )
+            result["assert_condition"] = match.group("condition")
+            break
+    for line in find_lines(log, CRASH_MARKERS["unhandled exception"]):
+        found.add("unhandled exception")
+        exception = line.partition(CRASH_MARKERS["unhandled exception"])[2]
+        result["exception"] = exception.strip(" :") or None
+        break
+    for kind in ("segfault", "crash"):
+        if CRASH_MARKERS[kind] in log:
+            found.add(kind)
+    if found:
+        frames = find_backtrace_frames(log)
+        if frames:
+            result["crash_frame"] = get_crash_frame(frames)
+
+    for kind in CRASH_KINDS:
+        if kind in found:
+            result["crash"] = kind
+            break
+    if result["crash"]:
+        detail = (
+            result["assert_location"]
+            if result["crash"] == "assertion"
+            else result["exception"]
+            if result["crash"] == "unhandled exception"
+            else None
+        ) or result["crash_frame"]
+        result["crash_signature"] = (
+            f"{result['crash']}: {detail}" if detail else result["crash"]
+        )
+    return result
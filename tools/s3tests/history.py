@@ -0,0 +1,135 @@
+#!/usr/bin/env python3
+"""
+Test runtimes of previous s3tr runs, read from results files or
+SQLite databases created by to-sqlite
+"""
+
+import logging
+import math
+import sqlite3
+import statistics
+
+import results as s3tr_results
+
+LOG = logging.getLogger("s3tr")
+
+
+def test_key(name):
+    """Key tests like to-sqlite and analyze: without the module path"""
+    return name.split("::")[-1]
+
+
+def percentile(values, p):
+    """Nearest-rank percentile of values. p in [0, 100]"""
+    values = sorted(values)
+    rank = max(1, math.ceil(p / 100 * len(values)))
+    return values[rank - 1]
+
+
+def is_sqlite(path):
+    with open(path, "rb") as fp:
+        return fp.read(16) == b"SQLite format 3\x00"
+
+
+def read_runtimes(path):
+    """
+    Iterate over (test key, runtime_ns, pytest_ns, success) of a results
+    file or database. pytest_ns is None for results of older versions
+    """
+    if is_sqlite(path):
+        with sqlite3.connect(path) as conn:
+            columns = {row[1] for row in conn.execute("pragma table_info(results)")}
+            pytest_ns = "pytest_ns" if "pytest_ns" in columns else "null"
+            yield from conn.execute(
+                f"select test, runtime_ns, {pytest_ns}, result = 'success' "
+                "from results where runtime_ns is not null"
+            )
+    else:
+        for result in s3tr_results.read_results(path, blobs=False):
+            if result.get("runtime_ns"):
+                yield (
+                    test_key(result["test"]),
+                    result["runtime_ns"],
+                    result.get("pytest_ns"),
+                    result["test_return"] == "success",
+                )
+
+
+class History:
+    """
+    Runtimes in ns by test of one or more previous runs. pytest times of
+    successful runs are also kept separately to derive timeouts
+    """
+
+    def __init__(self, paths=()):
+        self.runtimes_ns = {}
+        self.success_pytest_ns = {}
+        for path in paths:
+            for test, runtime_ns, pytest_ns, success in read_runtimes(path):
+                self.runtimes_ns.setdefault(test, []).append(runtime_ns)
+                if success and pytest_ns:
+                    self.success_pytest_ns.setdefault(test, []).append(pytest_ns)
+        if paths:
+            LOG.info(f"Loaded runtimes of {len(self.runtimes_ns)} tests from {paths}")
+        self.median_ns = (
+            statistics.median(
+                statistics.median(samples) for samples in self.runtimes_ns.values()
+            )
+            if self.runtimes_ns
+            else 0
+        )
+
+    def __bool__(self):
+        return bool(self.runtimes_ns)
+
+    def get(self, name):
+        return self.runtimes_ns.get(test_key(name))
+
+    def expected_ns(self, name):
+        """Median runtime of test. Median of all tests if unknown"""
+        samples = self.get(name)
+        return statistics.median(samples) if samples else self.median_ns
+
+    def p99_ns(self, name):
+        """
+        p99 pytest time (setup, call and teardown) of successful runs of
+        test. None if unknown
+        """
+        samples = self.success_pytest_ns.get(test_key(name))
+        return percentile(samples, 99) if samples else None
+
+    def timeout_sec(self, name, multiplier, floor_sec, ceiling_sec):
+        """
+        Timeout of test: multiplier times its p99 pytest time, clamped to
+        [floor_sec, ceiling_sec]. None if unknown
+        """
+        p99_ns = self.p99_ns(name)
+        if p99_ns is None:
+            return None
+        return min(max(multiplier * p99_ns / 10**9, floor_sec), ceiling_sec)
+
+    def schedule(self, batches):
+        """
+        Order batches longest processing time first. Long running tests
+        start early instead of extending the end of a run
+        """
+        return sorted(
+            batches,
+            key=lambda batch: sum(self.expected_ns(name) for name in batch),
+            reverse=True,
+        )
+
+    def estimate_left_ns(self, pending, observed_ns, nproc, p):
+        """
+        Estimate time to finish pending tests with nproc workers using
+        the p-th percentile of known runtimes. Tests without history
+        use runtimes observed in this run
+        """
+        if not pending or not observed_ns:
+            return 0
+        fallback = percentile(observed_ns, p)
+        estimates = [
+            percentile(self.get(name), p) if self.get(name) else fallback
+            for name in pending
+        ]
+        return max(sum(estimates) / nproc, max(estimates))
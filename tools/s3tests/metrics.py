@@ -0,0 +1,53 @@
+#!/usr/bin/env python3
+"""
+Parse s3gw Prometheus endpoint scrapes and compute per test deltas
+"""
+
+import logging
+
+from prometheus_client.parser import text_string_to_metric_families
+
+LOG = logging.getLogger("s3tr")
+
+# Metric types whose current value is reported instead of a delta
+ABSOLUTE_TYPES = frozenset(("gauge", "info", "stateset"))
+
+
+def series_key(name, labels):
+    """Series name in exposition format, e.g 'a_bucket{le="0.5"}'"""
+    if not labels:
+        return name
+    label_str = ",".join(f'{key}="{value}"' for key, value in sorted(labels.items()))
+    return f"{name}{{{label_str}}}"
+
+
+def parse(text):
+    """
+    Parse exposition format text into {series: (type, value)}.
+    Histograms are split into their _bucket, _sum and _count series
+    """
+    series = {}
+    try:
+        for family in text_string_to_metric_families(text):
+            for sample in family.samples:
+                series[series_key(sample.name, sample.labels)] = (
+                    family.type,
+                    sample.value,
+                )
+    except ValueError as e:
+        LOG.warning(f"Unparsable metrics: {e}")
+    return series
+
+
+def delta(baseline, final):
+    """
+    Series that changed between baseline and final scrape. Counters and
+    histograms as difference, gauges with their final value
+    """
+    result = {}
+    for key, (metric_type, value) in final.items():
+        _, base_value = baseline.get(key, (metric_type, 0.0))
+        if value == base_value:
+            continue
+        result[key] = value if metric_type in ABSOLUTE_TYPES else value - base_value
+    return result
@@ -0,0 +1,123 @@
+#!/usr/bin/env python3
+"""
+Fold perf script output into stack counts and render flame graphs
+
+Folded stacks are one line per distinct stack: frames from the root,
+separated by ";", then a space and the number of samples. The format
+of Brendan Gregg's stackcollapse scripts, understood by most flame
+graph tools.
+"""
+
+import collections
+import html
+import re
+
+# "radosgw 1 [003] 1234.567: 10101010 cpu-clock:"
+PERF_HEADER_RE = re.compile(r"^(?P<comm>\S.*?)\s+\d+(?:/\d+)?\s")
+
+# "\t    55d1c0e1b2a4 rgw::sal::SFStore::foo()+0x2a (/usr/bin/radosgw)"
+PERF_FRAME_RE = re.compile(r"^\s+[0-9a-f]+\s+(?P<symbol>.+?)(?:\+0x[0-9a-f]+)?\s+\(")
+
+SVG_WIDTH = 1200
+SVG_FRAME_HEIGHT = 16
+SVG_FONT_SIZE = 12
+# Frames narrower than this many pixels are not drawn
+SVG_MIN_WIDTH = 0.1
+
+
+def fold_perf_script(lines):
+    """Fold lines of perf script output. Return {stack: samples}"""
+    counts = collections.Counter()
+    comm = None
+    frames = []
+    for line in lines:
+        line = line.rstrip("\n")
+        if not line.strip():
+            if comm is not None:
+                counts[";".join([comm, *reversed(frames)])] += 1
+            comm = None
+            frames = []
+        elif comm is None:
+            match = PERF_HEADER_RE.match(line)
+            comm = match.group("comm") if match else line.split()[0]
+        else:
+            match = PERF_FRAME_RE.match(line)
+            frames.append(match.group("symbol") if match else "[unknown]")
+    if comm is not None:
+        counts[";".join([comm, *reversed(frames)])] += 1
+    return counts
+
+
+def format_folded(counts):
+    return "".join(f"{stack} {count}\n" for stack, count in sorted(counts.items()))
+
+
+def parse_folded(text):
+    counts = collections.Counter()
+    for line in text.splitlines():
+        stack, _, count = line.rpartition(" ")
+        if stack and count.isdigit():
+            counts[stack] += int(count)
+    return counts
+
+
+def make_tree(counts):
+    """Nested {frame: [samples, children]} of folded stacks"""
+    root = [0, {}]
+    for stack, count in counts.items():
+        node = root
+        node[0] += count
+        for frame in stack.split(";"):
+            node = node[1].setdefault(frame, [0, {}])
+            node[0] += count
+    return root
+
+
+def get_color(frame):
+    # Stable warm colors per frame name
+    digest = sum(frame.encode()) % 55
+    return f"rgb(230,{100 + digest * 2},{40 + digest})"
+
+
+def render_svg(counts, title):
+    """Render folded stacks as a flame graph SVG document"""
+    root = make_tree(counts)
+    total = root[0] or 1
+    scale = SVG_WIDTH / total
+    rects = []
+
+    def draw(children, x, depth):
+        for frame, (samples, grandchildren) in sorted(children.items()):
+            width = samples * scale
+            if width >= SVG_MIN_WIDTH:
+                rects.append((frame, samples, x, depth, width))
+                draw(grandchildren, x, depth + 1)
+            x += width
+
+    draw(root[1], 0.0, 0)
+    max_depth = max((depth for _, _, _, depth, _ in rects), default=0)
+    height = (max_depth + 3) * SVG_FRAME_HEIGHT
+    out = [
+        f'<svg xmlns="http://www.w3.org/2000/svg" width="{SVG_WIDTH}" '
+        f'height="{height}" font-family="monospace" font-size="{SVG_FONT_SIZE}">',
+        f'<text x="{SVG_WIDTH / 2}" y="{SVG_FRAME_HEIGHT}" '
+        f'text-anchor="middle">{html.escape(title)}</text>',
+    ]
+    for frame, samples, x, depth, width in rects:
+        y = height - (depth + 1) * SVG_FRAME_HEIGHT
+        label = html.escape(frame)
+        chars = int(width / (SVG_FONT_SIZE * 0.6))
+        text = label if len(frame) <= chars else html.escape(frame[: chars - 2] + "..")
+        out.append(
+            f"<g><title>{label} ({samples} samples, {samples / total:.2%})</title>"
+            f'<rect x="{x:.2f}" y="{y}" width="{width:.2f}" '
+            f'height="{SVG_FRAME_HEIGHT - 1}" fill="{get_color(frame)}"/>'
+            + (
+                f'<text x="{x + 2:.2f}" y="{y + SVG_FRAME_HEIGHT - 4}">{text}</text>'
+                if chars > 2
+                else ""
+            )
+            + "</g>"
+        )
+    out.append("</svg>\n")
+    return "\n".join(out)
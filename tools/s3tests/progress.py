@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+"""
+Prometheus metrics of a s3tr run in flight: finished tests, phase
+latencies, active workers and estimated time left
+"""
+
+import logging
+
+import prometheus_client
+
+LOG = logging.getLogger("s3tr")
+
+# Phase duration histogram buckets in seconds. From a reused container
+# restarting in well under a second to lifecycle tests running minutes
+PHASE_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+
+
+class RunMetrics:
+    """
+    Metrics of the runner itself, in their own registry so that only
+    they are served. serve() starts the HTTP endpoint
+    """
+
+    def __init__(self):
+        self.registry = prometheus_client.CollectorRegistry()
+        self.tests = prometheus_client.Counter(
+            "s3tr_tests",
+            "Finished test runs by test_return",
+            ["result"],
+            registry=self.registry,
+        )
+        self.crashes = prometheus_client.Counter(
+            "s3tr_container_crashes",
+            "Containers that died while pytest ran",
+            registry=self.registry,
+        )
+        self.flaky = prometheus_client.Counter(
+            "s3tr_flaky_tests",
+            "Tests that succeeded on retry",
+            registry=self.registry,
+        )
+        self.startup_failures = prometheus_client.Counter(
+            "s3tr_container_startup_failures",
+            "Containers that did not get ready",
+            registry=self.registry,
+        )
+        self.phases = prometheus_client.Histogram(
+            "s3tr_phase_seconds",
+            "Wall clock time of the phases of a test run, see phases_ns",
+            ["phase"],
+            buckets=PHASE_BUCKETS,
+            registry=self.registry,
+        )
+        self.active_workers = prometheus_client.Gauge(
+            "s3tr_active_workers",
+            "Workers running tests",
+            registry=self.registry,
+        )
+        self.tests_planned = prometheus_client.Gauge(
+            "s3tr_tests_planned",
+            "Tests to run",
+            registry=self.registry,
+        )
+        self.tests_pending = prometheus_client.Gauge(
+            "s3tr_tests_pending",
+            "Tests without result",
+            registry=self.registry,
+        )
+        self.eta = prometheus_client.Gauge(
+            "s3tr_eta_seconds",
+            "Estimated time left by runtime percentile",
+            ["percentile"],
+            registry=self.registry,
+        )
+
+    def serve(self, port):
+        prometheus_client.start_http_server(port, registry=self.registry)
+        LOG.info(f"Serving runner metrics on port {port}")
+
+    def observe_run(self, results):
+        """Count results of one run of a batch and its phase timings"""
+        for phase, ns in results[0]["phases_ns"].items():
+            self.phases.labels(phase).observe(ns / 10**9)
+        for result in results:
+            self.tests.labels(result["test_return"]).inc()
+        if results[0]["ready_ns"] is None:
+            self.startup_failures.inc()
+        elif any(result["test_return"] == "crash" for result in results):
+            self.crashes.inc()
+
+    def set_progress(self, total, pending, left_ns_by_percentile):
+        self.tests_planned.set(total)
+        self.tests_pending.set(pending)
+        for p, left_ns in left_ns_by_percentile.items():
+            self.eta.labels(f"p{p}").set(left_ns / 10**9)
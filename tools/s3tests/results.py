@@ -0,0 +1,386 @@
+#!/usr/bin/env python3
+"""
+Streaming s3tr results storage
+
+Results are JSON Lines, one object per test, appended as soon as a
+test finished. Large strings (e.g container logs) are written to gzip
+compressed side files in the <results>.d directory and replaced by a
+reference {"$file": "<results>.d/<name>"} relative to the results
+file's directory.
+
+Readers also accept the old format: a single JSON array.
+
+A test has more than one result only until compact() merged them, e.g
+after reruns.
+
+Lookups of single results use a SQLite index of test names to byte
+offsets in <results>.idx, built on first use and extended as results
+are appended.
+"""
+
+import collections
+import contextlib
+import gzip
+import itertools
+import json
+import logging
+import os
+import pathlib
+import shutil
+import sqlite3
+import zlib
+
+LOG = logging.getLogger("s3tr")
+
+# Result keys that may hold large strings
+BLOB_KEYS = ("container_logs", "metrics", "test_output", "profile")
+
+# Strings shorter than this stay inline
+BLOB_MIN_SIZE = 4096
+
+# Favor speed, logs compress well anyway
+BLOB_COMPRESSLEVEL = 1
+
+
+def blob_dir(path):
+    path = pathlib.Path(path)
+    return path.with_name(path.name + ".d")
+
+
+def is_blob_ref(value):
+    return isinstance(value, dict) and "$file" in value
+
+
+def load_blob(path, value):
+    """
+    Return value of a result key. Loads side file if value is a blob
+    reference
+    """
+    if not is_blob_ref(value):
+        return value
+    with gzip.open(pathlib.Path(path).parent / value["$file"], "rt") as fp:
+        return fp.read()
+
+
+def load_blobs(path, result, keys=BLOB_KEYS):
+    for key in keys:
+        if key in result:
+            result[key] = load_blob(path, result[key])
+    return result
+
+
+def index_path(path):
+    path = pathlib.Path(path)
+    return path.with_name(path.name + ".idx")
+
+
+def is_json_array(fp):
+    while ch := fp.read(1):
+        if not ch.isspace():
+            fp.seek(0)
+            return ch == "["
+    fp.seek(0)
+    return False
+
+
+def read_results(path, blobs=True):
+    """
+    Iterate over results in path. With blobs=False side file references
+    are not resolved
+    """
+    with open(path) as fp:
+        if is_json_array(fp):
+            results = json.load(fp)
+        else:
+            results = read_lines(fp)
+        for result in results:
+            if blobs:
+                load_blobs(path, result)
+            yield result
+
+
+def read_lines(fp):
+    for lineno, line in enumerate(fp, start=1):
+        if not line.strip():
+            continue
+        try:
+            yield json.loads(line)
+        except json.JSONDecodeError:
+            # Incomplete last line of an interrupted run
+            LOG.warning(f"{fp.name}:{lineno}: skipping unparsable result")
+
+
+class ResultWriter:
+    """
+    Append results to a JSON Lines file. Existing results are kept
+    unless truncate is set
+    """
+
+    def __init__(self, path, truncate=False):
+        self.path = pathlib.Path(path)
+        self.blob_dir = blob_dir(self.path)
+        if truncate:
+            with open(self.path, "w"):
+                pass
+            shutil.rmtree(self.blob_dir, ignore_errors=True)
+            index_path(self.path).unlink(missing_ok=True)
+        self.blob_dir.mkdir(parents=True, exist_ok=True)
+        self.fp = open(self.path, "a+")  # noqa: SIM115
+        self.drop_incomplete_line()
+        self.blob_ids = itertools.count(len(os.listdir(self.blob_dir)))
+
+    def drop_incomplete_line(self):
+        """Truncate a partially written last line"""
+        self.fp.seek(0)
+        if is_json_array(self.fp):
+            raise ValueError(f"{self.path} is a JSON array, not a JSON Lines file")
+        end = 0
+        while line := self.fp.readline():
+            if not line.endswith("\n"):
+                LOG.warning(f"{self.path}: dropping incomplete last result")
+                self.fp.truncate(end)
+                break
+            end = self.fp.tell()
+        self.fp.seek(0, os.SEEK_END)
+
+    def open_blob(self, name, key):
+        """
+        Create a new side file. Return text file object to write the
+        value to and the reference to store as result value
+        """
+        for blob_id in self.blob_ids:
+            filename = f"{blob_id:05d}-{name}.{key}.gz"
+            try:
+                # Claim name. Blobs may be written from several threads
+                open(self.blob_dir / filename, "xb").close()  # noqa: SIM115
+            except FileExistsError:
+                continue
+            fp = gzip.open(
+                self.blob_dir / filename, "wt", compresslevel=BLOB_COMPRESSLEVEL
+            )
+            return fp, {"$file": f"{self.blob_dir.name}/{filename}"}
+
+    def write_blob(self, name, key, value):
+        fp, ref = self.open_blob(name, key)
+        with fp:
+            fp.write(value)
+        return ref
+
+    def write(self, results):
+        """
+        Write results. Blobs shared between results, e.g logs of a
+        batch, are only written once
+        """
+        written = {}
+        for result in results:
+            record = dict(result)
+            name = result["test"].split("::")[-1]
+            for key in BLOB_KEYS:
+                value = record.get(key)
+                if not isinstance(value, str) or len(value) < BLOB_MIN_SIZE:
+                    continue
+                if id(value) not in written:
+                    written[id(value)] = self.write_blob(name, key, value)
+                record[key] = written[id(value)]
+            self.fp.write(json.dumps(record) + "\n")
+        self.fp.flush()
+
+    def close(self):
+        self.fp.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class ResultIndex:
+    """
+    SQLite sidecar index of a JSON Lines results file. Maps test names
+    to byte offset and length of their line. Only new lines are indexed
+    if the results file grew since the last update; the index is
+    rebuilt if the file was rewritten
+    """
+
+    def __init__(self, path):
+        self.path = pathlib.Path(path)
+        self.db = sqlite3.connect(index_path(self.path))
+        with self.db:
+            self.db.execute(
+                "create table if not exists lines"
+                " (test text, key text, offset integer, length integer)"
+            )
+            self.db.execute("create index if not exists lines_key on lines (key)")
+            self.db.execute(
+                "create table if not exists state"
+                " (size integer, mtime_ns integer, end_offset integer,"
+                " last_offset integer, last_crc integer)"
+            )
+        self.update()
+
+    def line_crc(self, offset, length):
+        with open(self.path, "rb") as fp:
+            fp.seek(offset)
+            return zlib.crc32(fp.read(length))
+
+    def get_start_offset(self, stat):
+        """Offset to continue indexing from. None if up to date"""
+        state = self.db.execute("select * from state").fetchone()
+        if not state:
+            return 0
+        size, mtime_ns, end_offset, last_offset, last_crc = state
+        if (size, mtime_ns) == (stat.st_size, stat.st_mtime_ns):
+            return None
+        if stat.st_size >= end_offset and (
+            end_offset == 0
+            or self.line_crc(last_offset, end_offset - last_offset) == last_crc
+        ):
+            return end_offset
+        LOG.info(f"{self.path} was rewritten, rebuilding index")
+        self.db.execute("delete from lines")
+        return 0
+
+    def update(self):
+        stat = os.stat(self.path)
+        with self.db:
+            offset = self.get_start_offset(stat)
+            if offset is None:
+                return
+            last_offset = last_crc = 0
+            rows = []
+            with open(self.path, "rb") as fp:
+                fp.seek(offset)
+                for line in fp:
+                    if not line.endswith(b"\n"):
+                        # Incomplete, indexed once the writer finished it
+                        break
+                    try:
+                        test = json.loads(line)["test"]
+                    except (json.JSONDecodeError, KeyError, TypeError):
+                        test = None
+                    if test:
+                        rows.append((test, test.split("::")[-1], offset, len(line)))
+                    last_offset, last_crc = offset, zlib.crc32(line)
+                    offset += len(line)
+            self.db.executemany("insert into lines values (?, ?, ?, ?)", rows)
+            self.db.execute("delete from state")
+            self.db.execute(
+                "insert into state values (?, ?, ?, ?, ?)",
+                (stat.st_size, stat.st_mtime_ns, offset, last_offset, last_crc),
+            )
+        if rows:
+            LOG.debug(f"Indexed {len(rows)} results of {self.path}")
+
+    def find(self, test_name):
+        """
+        Return first result whose test is test_name or contains it.
+        Exact matches on the name without module path win. None if
+        not found
+        """
+        row = (
+            self.db.execute(
+                "select offset, length from lines where key = ?"
+                " order by offset limit 1",
+                (test_name,),
+            ).fetchone()
+            or self.db.execute(
+                "select offset, length from lines where instr(test, ?) > 0"
+                " order by offset limit 1",
+                (test_name,),
+            ).fetchone()
+        )
+        if not row:
+            return None
+        offset, length = row
+        with open(self.path, "rb") as fp:
+            fp.seek(offset)
+            return json.loads(fp.read(length))
+
+    def close(self):
+        self.db.close()
+
+
+def scan_for_result(path, test_name):
+    return next(
+        (
+            result
+            for result in read_results(path, blobs=False)
+            if test_name in result["test"]
+        ),
+        None,
+    )
+
+
+def find_result(path, test_name, keys=BLOB_KEYS):
+    """
+    Look up the first result of a test by name or substring. Only side
+    files of keys are loaded. None if not found
+    """
+    with open(path) as fp:
+        legacy = is_json_array(fp)
+    if legacy:
+        result = scan_for_result(path, test_name)
+    else:
+        try:
+            index = ResultIndex(path)
+        except sqlite3.OperationalError as e:
+            LOG.warning(f"Can't use index {index_path(path)}: {e}. Scanning")
+            result = scan_for_result(path, test_name)
+        else:
+            with contextlib.closing(index):
+                result = index.find(test_name)
+    return load_blobs(path, result, keys) if result else None
+
+
+def compact(path, merge):
+    """
+    Rewrite path with one result per test, in order of first result.
+    merge(results) returns the result to keep of all results of a test.
+    Side files are kept. Nothing to do if all tests have one result
+    """
+    path = pathlib.Path(path)
+    by_test = {}
+    for result in read_results(path, blobs=False):
+        by_test.setdefault(result["test"], []).append(result)
+    if all(len(results) == 1 for results in by_test.values()):
+        return
+    tmp_path = path.with_name(f"{path.name}.{os.getpid()}.tmp")
+    with open(tmp_path, "w") as fp:
+        for results in by_test.values():
+            fp.write(json.dumps(merge(results)) + "\n")
+    os.replace(tmp_path, path)
+    index_path(path).unlink(missing_ok=True)
+
+
+def read_merged_results(path, merge, blobs=True):
+    """
+    Iterate over results in path, one per test like after compact().
+    Results of a test recorded more than once, e.g by a run interrupted
+    before compact(), are merged with merge(results) after the last one
+    """
+    counts = collections.Counter(
+        result["test"] for result in read_results(path, blobs=False)
+    )
+    runs = {}
+    for result in read_results(path, blobs):
+        test = result["test"]
+        if counts[test] == 1:
+            yield result
+            continue
+        runs.setdefault(test, []).append(result)
+        if len(runs[test]) == counts[test]:
+            yield merge(runs.pop(test))
+
+
+def get_attempt_returns(result):
+    """test_return of every attempt of a result, including retries"""
+    return [attempt["test_return"] for attempt in result.get("attempts") or [result]]
+
+
+def recorded_tests(path):
+    """Names of tests with results in path"""
+    path = pathlib.Path(path)
+    if not path.exists():
+        return set()
+    return {result["test"] for result in read_results(path, blobs=False)}
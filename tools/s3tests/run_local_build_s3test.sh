@@ -103,9 +103,15 @@ then
         /out/s3tr.json \
 	/ceph/qa/rgw/store/sfs/tests/fixtures/s3tr_excuses.csv
 else
-  jq  -r "first | .test_output" "${OUTPUT_DIR}"/s3tr.json
+  docker run --rm \
+    -v "${OUTPUT_DIR}":/out \
+      ghcr.io/s3gw-tech/s3tr:latest \
+        analyze test-out \
+        /out/s3tr.json \
+        "${SINGLE_S3_TEST}"
   echo "============================================================"
   echo "COMMAND TO GET RADOSGW LOGS:"
-  echo "jq -r 'first | .container_logs' ${OUTPUT_DIR}/s3tr.json"
+  echo "docker run --rm -v ${OUTPUT_DIR}:/out ghcr.io/s3gw-tech/s3tr:latest" \
+    "analyze logs /out/s3tr.json ${SINGLE_S3_TEST}"
   echo "============================================================"
 fi
@@ -4,30 +4,113 @@ A s3-tests runner tailored to s3gw containers with parallel execution,
 result and log gathering
 """
 
+import asyncio
+import codecs
+import concurrent.futures
+import datetime
 import io
+import itertools
 import json
 import logging
-import multiprocessing
 import os
 import pathlib
 import random
+import re
+import statistics
 import subprocess
 import sys
 import tarfile
 import tempfile
+import threading
 import time
-from contextlib import suppress
+import urllib.parse
+from contextlib import closing, suppress
 
+import classify
 import click
 import docker
+import metrics as s3tr_metrics
+import profiling
 import radosgw
 import requests
+import results as s3tr_results
+from cache import ResultCache
+from history import History
+from progress import RunMetrics
 
 LOG = logging.getLogger("s3tr")
 
-# How long an individual pytest may run in seconds
+# How long an individual pytest may run in seconds. Per test in a
+# batch. Used for tests without runtime history
 PYTEST_TIMEOUT_SEC = 100
 
+# With --history, tests time out after this multiple of their p99
+# pytest time (setup, call and teardown) of successful runs, clamped to
+# floor and ceiling
+TIMEOUT_MULTIPLIER = 3
+TIMEOUT_FLOOR_SEC = 10
+TIMEOUT_CEILING_SEC = 600
+
+# Added to timeouts from history for pytest start and test collection,
+# which precede the first test
+PYTEST_STARTUP_SEC = 10
+
+# How long to wait for a started radosgw to answer S3 requests
+READY_TIMEOUT_SEC = 60
+# Interval between readiness probes of the S3 frontend
+READY_PROBE_INTERVAL_SEC = 0.05
+# Interval between container state checks while waiting for readiness
+READY_STATE_CHECK_INTERVAL_SEC = 0.5
+# How long to wait for container.logs() to return something
+LOGS_TIMEOUT_SEC = 10
+# Read size when copying container logs
+LOG_CHUNK_SIZE = 1 << 20
+
+# Upper bound of threads doing blocking Docker API calls per worker.
+# Also the Docker client connection pool size
+THREADS_PER_WORKER = 4
+
+# With --tmpfs-size, tests with names containing one of these run with
+# /data on disk. They write objects that may not fit in memory
+DISK_TEST_PATTERNS = ("multipart", "_large", "_big", "_huge")
+
+# Tests that spent at least this fraction of their pytest phase stalled
+# on I/O (cgroup io.pressure "some") are reported as I/O bound
+IO_BOUND_FRACTION = 0.1
+
+# Docker API timestamp: seconds, fraction down to ns and UTC offset
+DOCKER_TIME_RE = re.compile(
+    r"(?P<seconds>\d{4}-\d\d-\d\dT\d\d:\d\d:\d\d)(?:\.(?P<fraction>\d{1,9}))?"
+    r"(?P<offset>Z|[+-]\d\d:\d\d)"
+)
+
+# cgroup v2 files read by S3GW.cgroup_stats()
+CGROUP_FILES = ("io.pressure", "cpu.stat", "io.stat")
+
+# perf record sampling frequency of --profile tests
+PROFILE_FREQUENCY_HZ = 99
+
+# Capabilities perf needs to pass Docker's default seccomp profile
+PROFILE_CAPS = ["SYS_ADMIN"]
+
+# radosgw --debug-rgw level of full logs. The default. With a lower
+# --debug-rgw, tests that did not succeed are rerun at this level
+FULL_DEBUG_RGW = 10
+
+# Log tail to classify when a container died during pytest
+CRASH_LOG_TAIL_BYTES = 1 << 20
+
+# Keys of each run kept in the repeats list of --repeat results
+REPEAT_KEYS = (
+    "test_return",
+    "container_return",
+    "container_logs",
+    "runtime_ns",
+    "ready_ns",
+    "phases_ns",
+    "crash_signature",
+)
+
 # From vstart.sh::do_rgw_create_users
 S3TESTS_USERS = {
     "s3 main": {
@@ -55,7 +138,9 @@ S3TESTS_USERS = {
 }
 
 
-def make_radosgw_command(id: str, port: int, lifecycle_debug: bool):
+def make_radosgw_command(
+    id: str, port: int, lifecycle_debug: bool, debug_rgw: int = FULL_DEBUG_RGW
+):
     return [
         "stdbuf",
         "-oL",
@@ -98,24 +183,159 @@ def make_radosgw_command(id: str, port: int, lifecycle_debug: bool):
         "--log-max-recent",
         "1",
         "--debug-rgw",
-        "10",
+        str(debug_rgw),
         "--rgw-frontends",
         f'"beast port={port}, status bind=0.0.0.0 port={port + 10000}"',
         "2>&1 1> /log",
     ]
 
 
+def make_container_command(radosgw_command):
+    """
+    Wrap radosgw command in a startup script that supports pooled
+    containers and golden copies: If /snapshot exists, /data is copied
+    to /golden. If /golden exists, /data is restored from it. See
+    S3GW.snapshot(), S3GW.reset() and S3GW.golden
+    """
+    return [
+        "if [ -e /snapshot ]; then",
+        "rm -f /snapshot && rm -rf /golden && cp -a /data /golden;",
+        "elif [ -d /golden ]; then",
+        "rm -rf /data/* && cp -a /golden/. /data/;",
+        "fi;",
+        "exec",
+    ] + radosgw_command
+
+
+def parse_docker_time_ns(timestamp):
+    """
+    ns since the epoch of a Docker API timestamp like
+    2024-05-02T10:00:00.123456789Z or, from Podman,
+    2024-05-02T12:00:00.123456789+02:00. 0 if it can't be parsed
+    """
+    match = DOCKER_TIME_RE.fullmatch(timestamp)
+    if not match:
+        return 0
+    offset = match.group("offset").replace("Z", "+00:00")
+    try:
+        dt = datetime.datetime.fromisoformat(match.group("seconds") + offset)
+    except ValueError:
+        return 0
+    fraction = (match.group("fraction") or "").ljust(9, "0")
+    return int(dt.timestamp()) * 10**9 + int(fraction)
+
+
+def parse_cgroup_stats(text):
+    """Parse output of S3GW.cgroup_stats()"""
+    files = {}
+    for line in text.splitlines():
+        if line.startswith("== "):
+            lines = files.setdefault(line[3:], [])
+        elif files:
+            lines.append(line)
+    stats = {}
+    for line in files.get("io.pressure", []):
+        if line.startswith("some "):
+            fields = dict(field.split("=") for field in line.split()[1:])
+            stats["io_stall_us"] = int(fields["total"])
+    for line in files.get("cpu.stat", []):
+        key, _, value = line.partition(" ")
+        if key == "usage_usec":
+            stats["cpu_usec"] = int(value)
+    for line in files.get("radosgw.status", []):
+        key, _, value = line.partition(":")
+        if key == "VmHWM":
+            stats["rss_peak"] = int(value.split()[0]) * 1024
+    io_stat = files.get("io.stat", [])
+    if "io.stat" in files:
+        stats["io_rbytes"] = stats["io_wbytes"] = 0
+    for line in io_stat:
+        for field in line.split()[1:]:
+            key, _, value = field.partition("=")
+            if key in ("rbytes", "wbytes"):
+                stats[f"io_{key}"] += int(value)
+    return stats
+
+
+def get_container_hints(name, disk_patterns=(), profile_patterns=()):
+    hints = set()
+    if "_lifecycle" in name:
+        hints.add("lifecycle")
+    if any(pattern in name for pattern in disk_patterns):
+        hints.add("disk")
+    if any(pattern in name for pattern in profile_patterns):
+        hints.add("profile")
+    return frozenset(hints)
+
+
+class ChunkStream(io.RawIOBase):
+    """Read-only file object over an iterator of bytes chunks"""
+
+    def __init__(self, chunks):
+        self.chunks = iter(chunks)
+        self.buf = b""
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        while not self.buf:
+            self.buf = next(self.chunks, None)
+            if self.buf is None:
+                self.buf = b""
+                return 0
+        n = min(len(b), len(self.buf))
+        b[:n] = self.buf[:n]
+        self.buf = self.buf[n:]
+        return n
+
+
+def rename_archive(chunks, src, dst):
+    """
+    Bytes of a tar archive with the entries of the tar stream chunks,
+    e.g from get_archive(), with top level directory src renamed to dst
+    """
+    out = io.BytesIO()
+    with closing(chunks), tarfile.open(
+        fileobj=ChunkStream(chunks), mode="r|"
+    ) as src_tf, tarfile.open(fileobj=out, mode="w") as dst_tf:
+        for entry in src_tf:
+            entry.name = dst + entry.name[len(src) :]
+            if entry.islnk():
+                entry.linkname = dst + entry.linkname[len(src) :]
+            dst_tf.addfile(entry, src_tf.extractfile(entry) if entry.isfile() else None)
+    return out.getvalue()
+
+
 class S3GW:
     """
     An S3GW container.
 
     Lifecycle: start(), stop(), remove()
+    Pooled lifecycle: start(), provision(), snapshot(), (stop(), reset())*, remove()
+    Golden copy: start(), provision(), stop(), golden_archive(), remove()
     Resources: logs(), logfile(), network_address()
-    Status: http_up()
+    Status: http_up(), wait_ready(), cgroup_stats()
+    Profiling: start_profile(), stop_profile()
     Admin OPs: create_user()
+
+    Methods block on the Docker API, except the async wait_ready(),
+    snapshot() and reset().
     """
 
-    def __init__(self, cri, image, container_run_args, name, port, hints):
+    def __init__(
+        self,
+        cri,
+        image,
+        container_run_args,
+        name,
+        port,
+        hints,
+        tmpfs_size=None,
+        publish_host=None,
+        golden=None,
+        debug_rgw=FULL_DEBUG_RGW,
+    ):
         self.cri = cri
         self.image = image
         self.container_run_args = container_run_args
@@ -123,9 +343,27 @@ class S3GW:
         self.port = port
         self.container = None
         self.hints = hints
+        # /data on a tmpfs of this size, unless the tests need a disk
+        self.tmpfs_size = None if "disk" in hints else tmpfs_size
+        # Reach the container through ports published on this host
+        # instead of its address on the Docker network
+        self.publish_host = publish_host
+        # Archive of a provisioned /data from golden_archive(). Copied to
+        # /golden before start, so that /data starts from it
+        self.golden = golden
+        self.debug_rgw = debug_rgw
+        self.tests_run = 0
+        self.started_ns = None
+        # Start by the clock of the Docker host. Events have timeNano
+        # of that clock
+        self.started_time_ns = 0
 
     def start(self):
-        command = make_radosgw_command(self.name, self.port, "lifecycle" in self.hints)
+        command = make_container_command(
+            make_radosgw_command(
+                self.name, self.port, "lifecycle" in self.hints, self.debug_rgw
+            )
+        )
         kwargs = self.container_run_args | {
             "image": self.image,
             "name": f"s3gw_{self.name}",
@@ -135,7 +373,31 @@ class S3GW:
             "entrypoint": "/bin/sh",
             "command": ["-c", " ".join(command)],
         }
-        container = self.cri.containers.run(**kwargs)
+        if self.tmpfs_size:
+            kwargs["tmpfs"] = self.container_run_args.get("tmpfs", {}) | {
+                "/data": f"size={self.tmpfs_size}"
+            }
+        if "profile" in self.hints:
+            kwargs["cap_add"] = (
+                self.container_run_args.get("cap_add", []) + PROFILE_CAPS
+            )
+        if self.publish_host:
+            kwargs["ports"] = {
+                f"{port}/tcp": port for port in (self.port, self.port + 10000)
+            }
+        self.started_ns = time.perf_counter_ns()
+        if self.golden:
+            try:
+                container = self.cri.containers.create(**kwargs)
+            except docker.errors.ImageNotFound:
+                # Unlike run(), create() does not pull missing images
+                LOG.info(f"Pulling {self.image}")
+                self.cri.images.pull(self.image)
+                container = self.cri.containers.create(**kwargs)
+            container.put_archive("/", self.golden)
+            container.start()
+        else:
+            container = self.cri.containers.run(**kwargs)
         LOG.debug(
             "running s3gw container %s with %r status %s",
             container.name,
@@ -145,27 +407,143 @@ class S3GW:
         assert container.status != "exited"
         self.container = container
         self.container.reload()
+        self.started_time_ns = parse_docker_time_ns(
+            self.container.attrs["State"]["StartedAt"]
+        )
 
     def network_address(self):
-        for retry in range(5):
-            addr = self.container.attrs["NetworkSettings"]["IPAddress"]
-            if addr:
-                return addr
-            time.sleep(2 * (retry + 1))
+        if self.publish_host:
+            return self.publish_host
+        # A running container has an address. Reload once in case
+        # attrs are from before start
+        addr = self.container.attrs["NetworkSettings"]["IPAddress"]
+        if not addr:
             self.container.reload()
+            addr = self.container.attrs["NetworkSettings"]["IPAddress"]
+        if addr:
+            return addr
         raise RuntimeError(
-            f"Container has no network address after {retry} tries. "
+            f"Container has no network address in state {self.container.status}. "
             "Startup failed? "
             "Check container logs."
         )
 
     def http_up(self):
         try:
-            resp = requests.head(f"http://{self.network_address()}:{self.port}")
+            resp = requests.head(
+                f"http://{self.network_address()}:{self.port}", timeout=(0.25, 1)
+            )
             return resp.ok
-        except requests.exceptions.ConnectionError:
+        except (
+            requests.exceptions.ConnectionError,
+            requests.exceptions.Timeout,
+            RuntimeError,
+        ):
             return False
 
+    async def wait_ready(self):
+        """
+        Probe the S3 frontend until it answers. Give up after
+        READY_TIMEOUT_SEC or as soon as the container is no longer
+        running. Return ns from container start to ready or None.
+        """
+        deadline = time.monotonic() + READY_TIMEOUT_SEC
+        next_state_check = time.monotonic() + READY_STATE_CHECK_INTERVAL_SEC
+        while time.monotonic() < deadline:
+            if await asyncio.to_thread(self.http_up):
+                ready_ns = time.perf_counter_ns() - self.started_ns
+                LOG.debug(
+                    "s3gw container %s ready after %.3fs",
+                    self.container.name,
+                    ready_ns / 10**9,
+                )
+                return ready_ns
+            if time.monotonic() >= next_state_check:
+                await asyncio.to_thread(self.container.reload)
+                if self.container.status not in ("created", "running"):
+                    LOG.warning(
+                        "s3gw container %s %s while waiting for readiness",
+                        self.container.name,
+                        self.container.status,
+                    )
+                    return None
+                next_state_check = time.monotonic() + READY_STATE_CHECK_INTERVAL_SEC
+            await asyncio.sleep(READY_PROBE_INTERVAL_SEC)
+        LOG.warning(
+            "s3gw container %s not ready after %ds",
+            self.container.name,
+            READY_TIMEOUT_SEC,
+        )
+        return None
+
+    def cgroup_stats(self):
+        """
+        Resource usage of the container since it started, from its
+        cgroup v2 files, and peak RSS of radosgw. Keys of unavailable
+        values are missing
+        """
+        try:
+            ret, out = self.container.exec_run(
+                [
+                    "/bin/sh",
+                    "-c",
+                    # Only sections of readable files. An empty io.stat
+                    # means no I/O, a missing one unknown
+                    f"cd /sys/fs/cgroup; for f in {' '.join(CGROUP_FILES)}; do "
+                    'if [ -r "$f" ]; then echo "== $f"; cat "$f" 2>/dev/null; fi; '
+                    "done; "
+                    # cgroup memory counts page cache and tmpfs /data
+                    "for p in /proc/[0-9]*; do "
+                    'if [ "$(cat $p/comm 2>/dev/null)" = radosgw ]; then '
+                    'echo "== radosgw.status"; cat $p/status 2>/dev/null; fi; '
+                    "done",
+                ]
+            )
+        except docker.errors.APIError:
+            return {}
+        if ret is None:
+            return {}
+        return parse_cgroup_stats(out.decode(errors="replace"))
+
+    def start_profile(self):
+        """Sample radosgw (PID 1) with perf record in the background"""
+        self.container.exec_run(
+            [
+                "/bin/sh",
+                "-c",
+                "echo $$ > /profile.pid && exec perf record -g -q "
+                f"-F {PROFILE_FREQUENCY_HZ} -p 1 -o /profile.data",
+            ],
+            detach=True,
+        )
+
+    def stop_profile(self):
+        """
+        Stop perf record. Return folded stacks of the samples, None if
+        there are none, e.g the container died
+        """
+        try:
+            _, out = self.container.exec_run(
+                [
+                    "/bin/sh",
+                    "-c",
+                    "pid=$(cat /profile.pid) && kill -INT $pid && "
+                    "while kill -0 $pid 2>/dev/null; do sleep 0.1; done && "
+                    "perf script -i /profile.data 2>/dev/null",
+                ],
+                stream=True,
+            )
+        except docker.errors.APIError as e:
+            LOG.warning(f"No profile of {self.name}: {e}")
+            return None
+        lines = io.TextIOWrapper(
+            io.BufferedReader(ChunkStream(out)), encoding="utf-8", errors="replace"
+        )
+        counts = profiling.fold_perf_script(lines)
+        if not counts:
+            LOG.warning(f"No profile samples of {self.name}. perf missing?")
+        return profiling.format_folded(counts) if counts else None
+
     def metrics(self):
         try:
             resp = requests.get(
@@ -185,44 +563,103 @@ class S3GW:
         )
         return rgwadmin.create_user(**kwargs)
 
+    def provision(self):
+        """Create S3TESTS_USERS. Nothing to do if started from golden"""
+        if self.golden:
+            return
+        for user in S3TESTS_USERS.values():
+            ret = self.create_user(**user)
+            LOG.debug(f"Created test user: {ret}")
+
+    def golden_archive(self):
+        """
+        Archive of /data of the stopped container, as /golden for
+        containers started with it. /data must not be a tmpfs
+        """
+        chunks, _ = self.container.get_archive("/data")
+        return rename_archive(chunks, "data", "golden")
+
+    async def snapshot(self):
+        """
+        Restart container and save the current /data as golden copy
+        to restore on every reset()
+        """
+        await asyncio.to_thread(self.container.exec_run, ["touch", "/snapshot"])
+        await asyncio.to_thread(self.stop)
+        return await self.reset()
+
+    async def reset(self):
+        """
+        Start a stopped container with /data restored to the golden copy
+        """
+        self.started_ns = time.perf_counter_ns()
+        await asyncio.to_thread(self.container.start)
+        await asyncio.to_thread(self.container.reload)
+        self.started_time_ns = parse_docker_time_ns(
+            self.container.attrs["State"]["StartedAt"]
+        )
+        return await self.wait_ready()
+
     def logs(self):
         # container.logs() not 100% reliably get the logs right away.
         # sometimes only after a minute or so..
-        for retry in range(20):
+        deadline = time.monotonic() + LOGS_TIMEOUT_SEC
+        while time.monotonic() < deadline:
             logs = self.container.logs()
             if logs:
                 return logs.decode("utf-8")
-            LOG.info(f"no logs for {self.container} after {retry} tries")
-            time.sleep(2 * (retry + 1))
+            time.sleep(READY_PROBE_INTERVAL_SEC)
         LOG.warning(
-            f"no logs for {self.container} after 20 retries. returning not available"
+            f"no logs for {self.container} after {LOGS_TIMEOUT_SEC}s. "
+            "returning not available"
         )
         return "not available"
 
-    def logfile(self):
-        # reliable but slow alternative to logs(). needs the container
-        # to write to /logs
-        with tempfile.NamedTemporaryFile() as fp:
-            try:
-                bits, stat = self.container.get_archive("/log")
-                for chunk in bits:
-                    fp.write(chunk)
-            except docker.errors.NotFound:
-                LOG.error("logfile not found")
-                return "not found"
-            fp.seek(0)
-            log = io.BytesIO()
-            with tarfile.open(fp.name) as tf:
-                for entry in tf:
-                    fp = tf.extractfile(entry)
-                    if not fp:
-                        continue
-                    log.write(fp.read())
-                    break
-            log.seek(0)
-            return log.getvalue().decode("utf-8")
+    def logfile(self, fp=None, max_bytes=0, tail=False):
+        """
+        Copy /log out of the container. Reliable alternative to logs()
+        that works on stopped containers.
+
+        The tar archive from the Docker API is unpacked while it
+        streams in. Writes the log to the text file object fp or returns
+        it. max_bytes > 0 caps the log at its first or, with tail, last
+        max_bytes bytes.
+        """
+        out = io.StringIO() if fp is None else fp
+        try:
+            bits, stat = self.container.get_archive("/log")
+        except docker.errors.NotFound:
+            LOG.error("logfile not found")
+            out.write("not found")
+            return out.getvalue() if fp is None else None
+        decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+        with closing(bits), tarfile.open(fileobj=ChunkStream(bits), mode="r|") as tf:
+            for entry in tf:
+                log = tf.extractfile(entry)
+                if not log:
+                    continue
+                if max_bytes <= 0 or entry.size <= max_bytes:
+                    while chunk := log.read(LOG_CHUNK_SIZE):
+                        out.write(decoder.decode(chunk))
+                elif tail:
+                    skip = entry.size - max_bytes
+                    while skip > 0:
+                        skip -= len(log.read(min(skip, LOG_CHUNK_SIZE)))
+                    out.write(f"[s3tr: skipped first {entry.size - max_bytes} bytes]\n")
+                    while chunk := log.read(LOG_CHUNK_SIZE):
+                        out.write(decoder.decode(chunk))
+                else:
+                    # Flush a character split at max_bytes before the marker
+                    out.write(decoder.decode(log.read(max_bytes), final=True))
+                    out.write(f"\n[s3tr: skipped last {entry.size - max_bytes} bytes]")
+                out.write(decoder.decode(b"", final=True))
+                break
+        if fp is None:
+            return out.getvalue()
 
     def stop(self):
+        with suppress(docker.errors.APIError):
+            self.container.reload()
         LOG.debug(
             "s3gw stopping container %s. was in state %s",
             self.container,
@@ -304,126 +741,1165 @@ display_name = youruseridhere
     """
 
 
-def run_test(docker_api, image, container_run_args, s3_tests, name, port):
-    start_time_ns = time.perf_counter_ns()
-    cri = docker.DockerClient(base_url=docker_api)
-    container_name = name.split("::")[1]
-    container_hints = set()
-    if "_lifecycle" in name:
-        container_hints.add("lifecycle")
-    container = S3GW(
-        cri, image, container_run_args, container_name, port, container_hints
+def get_shared_groups(batches, shared, disk_patterns=(), profile_patterns=()):
+    """
+    Group batches into groups of up to shared batches that can run
+    concurrently against one container. Profiled batches run alone, so
+    that their samples are theirs
+    """
+    groups = []
+    open_groups = {}
+    for batch in batches:
+        hints = get_container_hints(batch[0], disk_patterns, profile_patterns)
+        group = open_groups.get(hints)
+        if group is None or len(group) >= shared or "profile" in hints:
+            group = open_groups[hints] = []
+            groups.append(group)
+        group.append(batch)
+    return groups
+
+
+# pytest outcomes that make a single test pytest run exit with 0
+PYTEST_SUCCESS_OUTCOMES = frozenset(("passed", "skipped", "xfailed", "xpassed"))
+
+
+def get_batches(tests, batch_size, disk_patterns=(), profile_patterns=()):
+    """
+    Group tests into batches of at most batch_size tests of the same
+    module that can share a container
+    """
+    groups = {}
+    for test in tests:
+        key = (
+            test.split("::")[0],
+            get_container_hints(test, disk_patterns, profile_patterns),
+        )
+        groups.setdefault(key, []).append(test)
+    return [
+        group[i : i + batch_size]
+        for group in groups.values()
+        for i in range(0, len(group), batch_size)
+    ]
+
+
+def get_verbose_outcomes(out):
+    """Parse test outcomes from pytest -v output"""
+    result = {}
+    for line in out.split("\n"):
+        parts = line.split()
+        if len(parts) >= 2 and "::" in parts[0]:
+            result[parts[0]] = parts[1].lower()
+    return result
+
+
+def get_killed_test(stdout, read_ns, killed_ns):
+    """
+    (test, ns it ran) of the test pytest -v output stdout ends in, i.e
+    the test running when pytest was killed at killed_ns. read_ns are
+    (stdout length, ns) after each read. None if between tests
+    """
+    parts = stdout.rsplit(b"\n", 1)[-1].split()
+    if len(parts) != 1 or b"::" not in parts[0]:
+        return None
+    start = stdout.rfind(parts[0])
+    started_ns = next(ns for length, ns in read_ns if length > start)
+    return parts[0].decode(), killed_ns - started_ns
+
+
+def get_test_output(test_data):
+    """
+    Reconstruct output of a single test from its pytest JSON report entry
+    """
+    out = [f"{test_data['nodeid']} {test_data['outcome'].upper()}"]
+    for stage in ("setup", "call", "teardown"):
+        for key in ("longrepr", "stdout", "stderr"):
+            value = test_data.get(stage, {}).get(key)
+            if value:
+                out.append(f"---- {stage} {key} ----")
+                out.append(value)
+    return "\n".join(out)
+
+
+def get_test_runtime_ns(test_data):
+    return int(
+        sum(
+            test_data.get(stage, {}).get("duration", 0)
+            for stage in ("setup", "call", "teardown")
+        )
+        * 10**9
     )
-    container.start()
 
-    for retry in range(10):
-        if container.http_up():
-            break
-        time.sleep(1 * retry)
 
-    if not container.http_up():
+async def run_pytest(host, port, s3_tests, names, died=None, timeout_sec=None):
+    """
+    Run tests in a single pytest process. Return dict of test name to
+    (test return, test output, test data, runtime_ns or None). pytest
+    is killed and unfinished tests return "crash" as soon as the future
+    died is done, "timeout" after timeout_sec (default
+    PYTEST_TIMEOUT_SEC per test). Also return (test, ns it ran) of the
+    test pytest was killed in, see get_killed_test()
+    """
+    start_time_ns = time.perf_counter_ns()
+    with tempfile.NamedTemporaryFile() as config_fp, \
+         tempfile.NamedTemporaryFile() as json_out_fp:  # fmt: skip
+        config_fp.write(mk_config(host, port, S3TESTS_USERS).encode("ascii"))
+        config_fp.flush()
+        cmd = [
+            "pytest",
+            "-v",
+            "--json-report",
+            f"--json-report-file={json_out_fp.name}",
+            "--",
+            *names,
+        ]
+        env = dict(**os.environ)
+        env["S3TEST_CONF"] = config_fp.name
+        # Test names as they start, to tell when the killed test started
+        env["PYTHONUNBUFFERED"] = "1"
+        LOG.debug(f"running {cmd} with {env} cwd {s3_tests}")
+        proc = await asyncio.create_subprocess_exec(
+            *cmd,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+            cwd=s3_tests,
+            env=env,
+        )
+        stdout = bytearray()
+        read_ns = []
+        killed = None
+
+        async def communicate():
+            while chunk := await proc.stdout.read(1 << 16):
+                stdout.extend(chunk)
+                read_ns.append((len(stdout), time.perf_counter_ns()))
+            return await proc.wait()
+
+        pytest = asyncio.ensure_future(communicate())
+        try:
+            done, _ = await asyncio.wait(
+                {pytest} | ({died} if died else set()),
+                timeout=timeout_sec or PYTEST_TIMEOUT_SEC * len(names),
+                return_when=asyncio.FIRST_COMPLETED,
+            )
+            if pytest in done:
+                ret = "success" if pytest.result() == 0 else "fail"
+            else:
+                killed_ns = time.perf_counter_ns()
+                proc.kill()
+                await pytest
+                ret = "crash" if done else "timeout"
+                killed = get_killed_test(bytes(stdout), read_ns, killed_ns)
+        except asyncio.CancelledError:
+            proc.kill()
+            pytest.cancel()
+            raise
+        except Exception as e:
+            LOG.exception("unhandled exception during tests %s. rethrowing.", names)
+            proc.kill()
+            raise e
+
+        out = stdout.decode("utf-8")
+        try:
+            data_out = json.load(json_out_fp)["tests"]
+        except Exception:
+            if ret not in ("timeout", "crash"):
+                raise
+            data_out = []
+
+    if len(names) == 1:
         return {
+            names[0]: (
+                ret,
+                out,
+                data_out[0] if data_out else {},
+                None,
+            )
+        }, killed
+
+    LOG.debug(
+        "batch of %d tests took %ds",
+        len(names),
+        (time.perf_counter_ns() - start_time_ns) / 10**9,
+    )
+    data_by_name = {test_data["nodeid"]: test_data for test_data in data_out}
+    verbose_outcomes = get_verbose_outcomes(out)
+    results = {}
+    for name in names:
+        if name in data_by_name:
+            test_data = data_by_name[name]
+            outcome = test_data["outcome"]
+            results[name] = (
+                "success" if outcome in PYTEST_SUCCESS_OUTCOMES else "fail",
+                get_test_output(test_data),
+                test_data,
+                get_test_runtime_ns(test_data),
+            )
+        elif ret in ("timeout", "crash"):
+            # pytest got killed before writing its JSON report. Tests
+            # that finished are listed in the verbose output
+            outcome = verbose_outcomes.get(name, ret)
+            if outcome == ret:
+                test_ret = ret
+            elif outcome in PYTEST_SUCCESS_OUTCOMES:
+                test_ret = "success"
+            else:
+                test_ret = "fail"
+            results[name] = (test_ret, out, {}, None)
+        else:
+            results[name] = ("fail", out, {}, None)
+    return results, killed
+
+
+class PhaseTimer:
+    """
+    Wall clock time of the phases of a test run. mark(phase) ends the
+    current phase. Repeated phases add up
+    """
+
+    def __init__(self):
+        self.start_ns = time.perf_counter_ns()
+        self.last_ns = self.start_ns
+        self.phases_ns = {}
+
+    def mark(self, phase):
+        now_ns = time.perf_counter_ns()
+        self.phases_ns[phase] = self.phases_ns.get(phase, 0) + now_ns - self.last_ns
+        self.last_ns = now_ns
+
+    def elapsed_ns(self):
+        """
+        ns since start, without the idle phase. A prestarted container
+        waiting for its worker is no part of the test's runtime
+        """
+        return time.perf_counter_ns() - self.start_ns - self.phases_ns.get("idle", 0)
+
+
+def get_debug_reruns(path):
+    """
+    Tests in results file path that did not succeed below
+    FULL_DEBUG_RGW and have no result at FULL_DEBUG_RGW yet
+    """
+    failed = {}
+    verbose = set()
+    for result in s3tr_results.read_results(path, blobs=False):
+        if result.get("debug_rgw", FULL_DEBUG_RGW) >= FULL_DEBUG_RGW:
+            verbose.add(result["test"])
+        elif result["test_return"] != "success":
+            failed[result["test"]] = True
+    return [test for test in failed if test not in verbose]
+
+
+def merge_debug_reruns(results):
+    """
+    Merge results of a test and its rerun at FULL_DEBUG_RGW. Keys are
+    from the rerun, unless it succeeded where the first run did not.
+    Then they are from the first run, except for the rerun's full
+    container_logs and its debug_rgw. Both runs are listed in debug_runs
+    """
+    if len(results) == 1:
+        return results[0]
+    first, rerun = results[0], results[-1]
+    result = rerun
+    if rerun["test_return"] == "success" and first["test_return"] != "success":
+        result = {
+            **first,
+            "container_logs": rerun["container_logs"],
+            "debug_rgw": rerun["debug_rgw"],
+        }
+    return {
+        **result,
+        "debug_runs": [
+            {key: run[key] for key in (*REPEAT_KEYS, "debug_rgw") if key in run}
+            for run in (first, rerun)
+        ],
+    }
+
+
+def merge_attempts(attempts):
+    """
+    Merge results of a test and its retries. Keys are from the last
+    attempt. All attempts are listed in attempts. A test is flaky if
+    a retry succeeded
+    """
+    return {
+        **attempts[-1],
+        "attempts": [
+            {key: attempt[key] for key in REPEAT_KEYS if key in attempt}
+            for attempt in attempts
+        ],
+        "flaky": attempts[-1]["test_return"] == "success",
+    }
+
+
+def merge_repeats(runs):
+    """
+    Merge results of repeated runs of the same tests into one result per
+    test. Keys are from the first run that failed, or the first run.
+    runtime_ns is the median runtime. All runs are listed in repeats
+    """
+    merged = []
+    for test_results in zip(*runs):
+        result = next(
+            (result for result in test_results if result["test_return"] != "success"),
+            test_results[0],
+        )
+        merged.append(
+            {
+                **result,
+                "runtime_ns": statistics.median(
+                    result["runtime_ns"] for result in test_results
+                ),
+                "repeats": [
+                    {key: result[key] for key in REPEAT_KEYS if key in result}
+                    for result in test_results
+                ],
+            }
+        )
+    return merged
+
+
+def get_metrics_delta(baseline, metrics):
+    """
+    Changes of metric series between the baseline scrape before a test
+    and the raw scrape text after it
+    """
+    return s3tr_metrics.delta(baseline, s3tr_metrics.parse(metrics))
+
+
+def make_resource_fields(container, stats_before, stats_after, pytest_ns):
+    """
+    Where /data was, resources used by the container from its start
+    until pytest finished and how long it stalled on I/O during pytest
+    """
+    fields = {
+        "data_dir": "tmpfs" if container.tmpfs_size else "disk",
+        "cpu_ns": None,
+        "mem_peak_bytes": stats_after.get("rss_peak"),
+        "io_read_bytes": stats_after.get("io_rbytes"),
+        "io_write_bytes": stats_after.get("io_wbytes"),
+        "io_stall_ns": None,
+        "io_bound": None,
+    }
+    if "cpu_usec" in stats_after:
+        fields["cpu_ns"] = stats_after["cpu_usec"] * 1000
+    if "io_stall_us" in stats_before and "io_stall_us" in stats_after:
+        stall_ns = (stats_after["io_stall_us"] - stats_before["io_stall_us"]) * 1000
+        fields["io_stall_ns"] = stall_ns
+        fields["io_bound"] = stall_ns >= IO_BOUND_FRACTION * pytest_ns
+    return fields
+
+
+def make_results(group, pytest_results, runtime_ns, container_fields, fields):
+    """
+    Make one result per test of the batches in group. runtime_ns is the
+    group's. container_fields are shared by all tests of the group,
+    fields by the tests of the batch at the same index
+    """
+    if len(group) > 1:
+        container_fields = {**container_fields, "shared": len(group)}
+    results = []
+    for names, batch_fields in zip(group, fields):
+        for name in names:
+            ret, out, data_out, test_runtime_ns = pytest_results[name]
+            if test_runtime_ns is None and len(group) > 1 and data_out:
+                # Container runtime is shared, pytest's is the test's own
+                test_runtime_ns = get_test_runtime_ns(data_out)
+            result = {
+                "test": name,
+                "test_return": ret,
+                **container_fields,
+                **batch_fields,
+                "test_output": out,
+                "test_data": data_out,
+                "runtime_ns": test_runtime_ns or runtime_ns,
+            }
+            if data_out:
+                result["pytest_ns"] = get_test_runtime_ns(data_out)
+            if len(names) > 1:
+                result["batch"] = names
+                result["batch_runtime_ns"] = runtime_ns
+            results.append(result)
+    return results
+
+
+def make_startup_failure_results(names, logs, timer):
+    return [
+        {
             "test": name,
             "test_return": "fail",
             "container_return": "fail",
-            "container_logs": container.logfile(),
+            "container_logs": logs,
             "test_output": "",
             "test_data": "",
-            "runtime_ns": time.perf_counter_ns() - start_time_ns,
+            "ready_ns": None,
+            "phases_ns": timer.phases_ns,
+            "runtime_ns": timer.elapsed_ns(),
         }
+        for name in names
+    ]
 
-    for user in S3TESTS_USERS.values():
-        ret = container.create_user(**user)
-        LOG.debug(f"Created test user: {ret}")
 
-    with tempfile.NamedTemporaryFile() as config_fp, \
-         tempfile.NamedTemporaryFile() as json_out_fp:  # fmt: skip
-        config_fp.write(
-            mk_config(container.network_address(), port, S3TESTS_USERS).encode("ascii")
+class DeathWatcher:
+    """
+    Follow "die" events of s3tr containers of one Docker API endpoint
+    in a thread. watch() returns a future done when a container died.
+    Events from before the container's last start are ignored, e.g a
+    reused container's previous stop
+    """
+
+    def __init__(self, cri, loop):
+        self.loop = loop
+        self.futures = {}
+        self.events = cri.events(
+            decode=True,
+            filters={"type": "container", "event": "die", "label": "s3gw_s3tests"},
         )
-        config_fp.flush()
+        self.thread = threading.Thread(target=self.follow, daemon=True)
+        self.thread.start()
+
+    def follow(self):
         try:
-            cmd = [
-                "pytest",
-                "-v",
-                "--json-report",
-                f"--json-report-file={json_out_fp.name}",
-                "--",
-                name,
-            ]
-            env = dict(**os.environ)
-            env["S3TEST_CONF"] = config_fp.name
-            LOG.debug(f"running {cmd} with {env} cwd {s3_tests}")
-            proc = subprocess.run(
-                cmd,
-                check=True,
-                stdout=subprocess.PIPE,
-                stderr=subprocess.STDOUT,
-                timeout=PYTEST_TIMEOUT_SEC,
-                cwd=s3_tests,
-                env=env,
-            )
-            ret = "success"
-            out = proc.stdout.decode("utf-8")
-            data_out = json.load(json_out_fp)["tests"][0]
-        except subprocess.CalledProcessError as e:
-            ret = "fail"
-            out = e.output.decode("utf-8")
-            data_out = json.load(json_out_fp)["tests"][0]
-        except subprocess.TimeoutExpired as e:
-            ret = "timeout"
-            out = e.output.decode("utf-8")
-            try:
-                data_out = json.load(json_out_fp)["tests"][0]
-            except Exception:
-                data_out = {}
+            for event in self.events:
+                future, since_ns = self.futures.get(event.get("id"), (None, 0))
+                if future is not None and event.get("timeNano", since_ns) >= since_ns:
+                    self.loop.call_soon_threadsafe(self.set_died, future, event)
         except Exception as e:
-            LOG.exception("unhandled exception during test %s. rethrowing.", name)
-            raise e
+            # Closing the event stream ends up here as well
+            LOG.debug(f"Stopped following container events: {e}")
+
+    @staticmethod
+    def set_died(future, event):
+        if not future.done():
+            future.set_result(event)
+
+    def watch(self, container, since_ns=0):
+        """
+        Future done when container dies. Ignore events before since_ns,
+        in ns since the epoch
+        """
+        future = self.loop.create_future()
+        self.futures[container.id] = (future, since_ns)
+        return future
+
+    def unwatch(self, container):
+        future, _ = self.futures.pop(container.id, (None, 0))
+        if future is not None:
+            future.cancel()
+
+    def close(self):
+        self.events.close()
+
+
+def get_publish_host(docker_api):
+    """
+    Host publishing container ports of a remote Docker API endpoint.
+    None for local endpoints, their containers are reachable directly
+    """
+    url = urllib.parse.urlparse(docker_api)
+    if url.scheme in ("tcp", "http", "https", "ssh"):
+        return url.hostname
+    return None
 
-    metrics = container.metrics()
-    container_ret = container.stop()
-    logs = container.logfile()
-    container.remove()
-    return {
-        "test": name,
-        "test_return": ret,
-        "container_return": container_ret,
-        "container_logs": logs,
-        "metrics": metrics,
-        "test_output": out,
-        "test_data": data_out,
-        "runtime_ns": time.perf_counter_ns() - start_time_ns,
-    }
 
+class DockerEndpoint:
+    """A Docker API endpoint and the number of workers using it"""
 
-def run_test_unpack(args):
-    return run_test(*args)
+    def __init__(self, docker_api, max_pool_size):
+        self.docker_api = docker_api
+        self.cri = docker.DockerClient(base_url=docker_api, max_pool_size=max_pool_size)
+        self.publish_host = get_publish_host(docker_api)
+        self.nproc = 0
+        self.watcher = None
+
+    def ncpu(self):
+        try:
+            return self.cri.info()["NCPU"]
+        except (docker.errors.APIError, requests.exceptions.ConnectionError) as e:
+            LOG.warning(f"Can't get CPU count of {self.docker_api}: {e}")
+            return 1
 
 
-def run_tests(docker_api, image, container_run_args, s3_tests, nproc, tests):
-    start_port = 10000
-    jobs = [
-        (docker_api, image, container_run_args, s3_tests, test, start_port + i)
-        for i, test in enumerate(tests)
+def make_endpoints(docker_apis, nproc):
+    """
+    Distribute nproc workers across docker_apis weighted by their CPU
+    count. Every endpoint gets at least one worker
+    """
+    endpoints = [
+        DockerEndpoint(docker_api, THREADS_PER_WORKER * nproc)
+        for docker_api in docker_apis
     ]
-    results = []
-    with multiprocessing.Pool(nproc) as pool:
-        for result in pool.imap_unordered(run_test_unpack, jobs, chunksize=1):
-            results.append(result)
-            if (len(results) % 10) == 0:
-                mean_runtime_ns = int(
-                    sum(r["runtime_ns"] for r in results) / len(results)
+    if len(endpoints) == 1:
+        endpoints[0].nproc = nproc
+        return endpoints
+    ncpus = [endpoint.ncpu() for endpoint in endpoints]
+    shares = [nproc * ncpu / sum(ncpus) for ncpu in ncpus]
+    for endpoint, share in zip(endpoints, shares):
+        endpoint.nproc = max(1, int(share))
+    # Largest remainder first
+    by_remainder = sorted(
+        range(len(endpoints)), key=lambda i: shares[i] - int(shares[i]), reverse=True
+    )
+    for i in by_remainder[: max(0, nproc - sum(e.nproc for e in endpoints))]:
+        endpoints[i].nproc += 1
+    for endpoint, ncpu in zip(endpoints, ncpus):
+        LOG.info(f"{endpoint.nproc} workers on {endpoint.docker_api} with {ncpu} CPUs")
+    return endpoints
+
+
+class Runner:
+    """
+    Run s3-tests with concurrent workers driven by a single asyncio
+    event loop. Each of the Docker API endpoints runs its share of
+    workers. Blocking Docker API calls run in threads sharing one Docker
+    client per endpoint. All workers take batches from one queue, so
+    faster endpoints run more tests.
+
+    Workers either start a fresh container per batch of tests or, if
+    pool_recycle > 0, keep a warm container that is reset between
+    batches and recycled after pool_recycle tests or a crash.
+
+    With prestart, fresh containers for a worker's next batch start
+    booting while the current batch's container is torn down.
+
+    With tmpfs_size set /data is a tmpfs of that size, except for tests
+    matching disk_patterns.
+
+    Tests matching profile_patterns run with radosgw sampled by perf.
+
+    With a cache, successful results are stored in it and
+    reuse_cached() skips tests with a cached successful result.
+
+    With repeat > 1 each batch is run repeat times in a row by the same
+    worker and recorded as one result per test (see merge_repeats()).
+
+    radosgw runs with --debug-rgw debug_rgw.
+
+    With golden_data, users are provisioned once per run in a golden
+    container. All other containers start with a copy of its /data.
+
+    With shared > 1 up to shared batches run concurrently, each in its
+    own pytest process, against one container. Workers take groups of
+    batches (see get_shared_groups()) from the queue. Otherwise each
+    group is a single batch.
+
+    With retries > 0 tests that did not succeed are retried alone in
+    fresh containers until they succeed, at most retries times (see
+    retry()).
+
+    With timeout_multiplier > 0 tests with history time out after
+    timeout_multiplier times their p99 runtime (see get_timeout()).
+
+    Progress, phase timings and outcomes are recorded in run_metrics.
+    """
+
+    def __init__(
+        self,
+        endpoints,
+        image,
+        container_run_args,
+        s3_tests,
+        pool_recycle,
+        writer,
+        log_max_bytes=0,
+        log_tail=False,
+        history=None,
+        repeat=1,
+        tmpfs_size=None,
+        disk_patterns=(),
+        prestart=True,
+        profile_patterns=(),
+        cache=None,
+        timeout_multiplier=TIMEOUT_MULTIPLIER,
+        run_metrics=None,
+        shared=1,
+        golden_data=False,
+        debug_rgw=FULL_DEBUG_RGW,
+        retries=0,
+    ):
+        self.endpoints = endpoints
+        self.image = image
+        self.container_run_args = container_run_args
+        self.s3_tests = s3_tests
+        self.nproc = sum(endpoint.nproc for endpoint in endpoints)
+        self.pool_recycle = pool_recycle
+        self.ports = itertools.count(10000)
+        self.writer = writer
+        self.log_max_bytes = log_max_bytes
+        self.log_tail = log_tail
+        self.history = history or History()
+        self.repeat = repeat
+        self.tmpfs_size = tmpfs_size
+        self.disk_patterns = disk_patterns
+        self.io_bound = 0
+        self.prestart = prestart
+        self.profile_patterns = profile_patterns
+        self.cache = cache
+        self.timeout_multiplier = timeout_multiplier
+        self.run_metrics = run_metrics or RunMetrics()
+        self.shared = shared
+        self.golden_data = golden_data
+        self.golden = None
+        self.debug_rgw = debug_rgw
+        self.retries = retries
+        self.pending = set()
+        self.runtimes_ns = []
+        self.total = 0
+
+    async def run(self, batches):
+        """
+        Run batches in order of the history schedule. Return number of
+        tests run
+        """
+        batches = self.history.schedule(batches)
+        self.runtimes_ns = []
+        self.io_bound = 0
+        self.total = sum(len(batch) for batch in batches)
+        self.pending = {name for batch in batches for name in batch}
+        self.run_metrics.set_progress(self.total, len(self.pending), {})
+        if not batches:
+            return 0
+        queue = asyncio.Queue()
+        for group in get_shared_groups(
+            batches, self.shared, self.disk_patterns, self.profile_patterns
+        ):
+            queue.put_nowait(group)
+        loop = asyncio.get_running_loop()
+        for endpoint in self.endpoints:
+            endpoint.watcher = await asyncio.to_thread(DeathWatcher, endpoint.cri, loop)
+        if self.golden_data and self.golden is None:
+            self.golden = await self.make_golden(self.endpoints[0])
+            # Don't try again in later runs, e.g of debug reruns
+            self.golden_data = self.golden is not None
+        try:
+            await asyncio.gather(
+                *(
+                    self.worker(queue, endpoint)
+                    for endpoint in self.endpoints
+                    for _ in range(endpoint.nproc)
                 )
-                estimated_time_left_ns = int(
-                    mean_runtime_ns * (len(jobs) - len(results)) / nproc
+            )
+        finally:
+            for endpoint in self.endpoints:
+                endpoint.watcher.close()
+        LOG.info(f"{self.io_bound} tests were I/O bound")
+        return len(self.runtimes_ns)
+
+    async def worker(self, queue, endpoint):
+        container = None
+        # (group, task preparing their container) of the next group
+        prestarted = None
+
+        def prestart():
+            nonlocal prestarted
+            if self.prestart and prestarted is None and not queue.empty():
+                group = queue.get_nowait()
+                prestarted = (
+                    group,
+                    asyncio.create_task(self.prepare(group, endpoint)),
                 )
+
+        self.run_metrics.active_workers.inc()
+        try:
+            while prestarted or not queue.empty():
+                group, prepared = prestarted or (queue.get_nowait(), None)
+                prestarted = None
+                runs = []
+                for repeat in range(self.repeat):
+                    if self.pool_recycle > 0:
+                        results, container = await self.run_test_pooled(
+                            group, container, endpoint
+                        )
+                    else:
+                        results = await self.run_test(
+                            group,
+                            endpoint,
+                            prepared,
+                            prestart if repeat == self.repeat - 1 else None,
+                        )
+                        prepared = None
+                    self.run_metrics.observe_run(results)
+                    runs.append(results)
+                if self.repeat > 1:
+                    results = merge_repeats(runs)
+                if self.retries > 0:
+                    results = await self.retry(results, endpoint)
+                for result in results:
+                    result["docker_api"] = endpoint.docker_api
+                    result["debug_rgw"] = self.debug_rgw
+                if self.cache:
+                    await asyncio.to_thread(self.store_cached, results)
+                self.add_results(results)
+        finally:
+            self.run_metrics.active_workers.dec()
+            if container is not None:
+                await self.recycle(container)
+            if prestarted is not None:
+                prestarted[1].cancel()
+
+    def get_cache_key(self, name):
+        hints = get_container_hints(name, self.disk_patterns, self.profile_patterns)
+        return self.cache.key(
+            name,
+            {
+                "radosgw_command": make_radosgw_command(
+                    "ID", 0, "lifecycle" in hints, self.debug_rgw
+                ),
+                "tmpfs_size": None if "disk" in hints else self.tmpfs_size,
+                "hints": sorted(hints),
+            },
+        )
+
+    def reuse_cached(self, tests):
+        """
+        Write cached successful results of tests. Return the tests
+        without one
+        """
+        missing = []
+        for name in tests:
+            key = self.get_cache_key(name)
+            cached = self.cache.get(key)
+            if cached and cached["test_return"] == "success":
+                self.writer.write([cached | {"cache_key": key, "cached": True}])
+            else:
+                missing.append(name)
+        LOG.info(f"Reused {len(tests) - len(missing)} cached results")
+        return missing
+
+    async def retry(self, results, endpoint):
+        """
+        Retry tests of results that did not succeed alone in fresh
+        containers until they succeed, at most retries times. Return
+        results with those of retried tests merged (see merge_attempts())
+        """
+        merged = []
+        for result in results:
+            attempts = [result]
+            while (
+                attempts[-1]["test_return"] != "success"
+                and len(attempts) <= self.retries
+            ):
                 LOG.info(
-                    f"{len(results)}/{len(jobs)} done. "
-                    f"mean runtime {int(mean_runtime_ns/10**9)}s. "
-                    f"estimated time left {int(estimated_time_left_ns/10**9)}s. "
+                    f"Retrying {result['test']} after {attempts[-1]['test_return']} "
+                    f"({len(attempts)}/{self.retries})"
                 )
-    return results
+                retry_results = await self.run_test([[result["test"]]], endpoint)
+                self.run_metrics.observe_run(retry_results)
+                attempts.extend(retry_results)
+            if len(attempts) > 1:
+                result = merge_attempts(attempts)
+                if result["flaky"]:
+                    LOG.warning(
+                        f"{result['test']} is flaky: succeeded on attempt "
+                        f"{len(attempts)}"
+                    )
+                    self.run_metrics.flaky.inc()
+            merged.append(result)
+        return merged
+
+    def store_cached(self, results):
+        for result in results:
+            result["cache_key"] = self.get_cache_key(result["test"])
+            # Flaky results are run again rather than trusted
+            if result["test_return"] == "success" and not result.get("flaky"):
+                self.cache.put(
+                    result["cache_key"],
+                    s3tr_results.load_blobs(self.writer.path, dict(result)),
+                )
+
+    def add_results(self, results):
+        self.writer.write(results)
+        for result in results:
+            self.pending.discard(result["test"])
+            if result.get("io_bound"):
+                self.io_bound += 1
+            if "batch" in result:
+                self.runtimes_ns.append(
+                    result["batch_runtime_ns"] / len(result["batch"])
+                )
+            else:
+                self.runtimes_ns.append(result["runtime_ns"])
+        left_ns = {
+            p: self.repeat
+            * self.history.estimate_left_ns(
+                self.pending, self.runtimes_ns, self.nproc, p
+            )
+            for p in (50, 90)
+        }
+        self.run_metrics.set_progress(self.total, len(self.pending), left_ns)
+        done = len(self.runtimes_ns)
+        if done // 10 > (done - len(results)) // 10:
+            mean_runtime_ns = int(sum(self.runtimes_ns) / done)
+            LOG.info(
+                f"{done}/{self.total} done. "
+                f"mean runtime {int(mean_runtime_ns/10**9)}s. "
+                f"estimated time left {int(left_ns[50]/10**9)}s "
+                f"(p90 {int(left_ns[90]/10**9)}s). "
+            )
+
+    def make_container(self, name, port, hints, endpoint):
+        return S3GW(
+            endpoint.cri,
+            self.image,
+            self.container_run_args,
+            name,
+            port,
+            hints,
+            self.tmpfs_size,
+            endpoint.publish_host,
+            self.golden,
+            self.debug_rgw,
+        )
+
+    async def make_golden(self, endpoint):
+        """
+        Provision users in a fresh container with /data on disk. Return
+        an archive of its /data, None if that failed
+        """
+        port = next(self.ports)
+        container = self.make_container(
+            f"golden_{port}", port, frozenset(("disk",)), endpoint
+        )
+        try:
+            start_ns = time.perf_counter_ns()
+            await asyncio.to_thread(container.start)
+            if await container.wait_ready() is None:
+                LOG.warning("Golden container did not get ready. Provisioning all")
+                return None
+            await asyncio.to_thread(container.provision)
+            await asyncio.to_thread(container.stop)
+            golden = await asyncio.to_thread(container.golden_archive)
+            LOG.info(
+                f"Created golden /data ({len(golden) / 2**10:.0f} KiB) in "
+                f"{(time.perf_counter_ns() - start_ns) / 10**9:.1f}s"
+            )
+            return golden
+        except Exception as e:
+            LOG.warning(f"Creating golden /data failed: {e!r}. Provisioning all")
+            return None
+        finally:
+            if container.container is not None:
+                await asyncio.to_thread(container.remove)
+
+    async def logfile(self, container, names):
+        """
+        Stream the container log into a compressed result side file.
+        Return the reference to store in results
+        """
+        fp, ref = self.writer.open_blob(names[0].split("::")[-1], "container_logs")
+        with fp:
+            await asyncio.to_thread(
+                container.logfile, fp, self.log_max_bytes, self.log_tail
+            )
+        return ref
+
+    def get_timeout(self, names):
+        """
+        pytest timeout in seconds of names. Sum of the per test timeouts
+        derived from history, PYTEST_TIMEOUT_SEC for tests without, plus
+        PYTEST_STARTUP_SEC
+        """
+        if self.timeout_multiplier <= 0:
+            return PYTEST_TIMEOUT_SEC * len(names)
+        return PYTEST_STARTUP_SEC + sum(
+            self.history.timeout_sec(
+                name, self.timeout_multiplier, TIMEOUT_FLOOR_SEC, TIMEOUT_CEILING_SEC
+            )
+            or PYTEST_TIMEOUT_SEC
+            for name in names
+        )
+
+    def get_timeout_fields(self, names, pytest_results, timeout_sec, killed):
+        """
+        Timeout of the pytest run and, if it timed out, the test it timed
+        out in and how long that test ran in multiples of its p99
+        """
+        fields = {"timeout_sec": timeout_sec}
+        if not any(ret == "timeout" for ret, *_ in pytest_results.values()):
+            return fields
+        if killed is None:
+            LOG.warning(
+                f"pytest of {len(names)} tests starting with {names[0]} timed out "
+                f"between tests (budget {timeout_sec:.1f}s)"
+            )
+            return fields
+        test, ran_ns = killed
+        fields["timeout_test"] = test
+        ran = f"{ran_ns / 10**9:.1f}s"
+        p99_ns = self.history.p99_ns(test)
+        if p99_ns:
+            fields["timeout_over_p99"] = ran_ns / p99_ns
+            ran += f", {fields['timeout_over_p99']:.1f}x its p99"
+        LOG.warning(
+            f"pytest timed out in {test} after it ran {ran} "
+            f"(budget {timeout_sec:.1f}s for {len(names)} tests)"
+        )
+        return fields
+
+    async def run_pytest_timed(self, host, port, names, died):
+        """run_pytest() with the timeout of names. Also return fields"""
+        timeout_sec = self.get_timeout(names)
+        pytest_results, killed = await run_pytest(
+            host, port, self.s3_tests, names, died, timeout_sec
+        )
+        return pytest_results, self.get_timeout_fields(
+            names, pytest_results, timeout_sec, killed
+        )
+
+    async def run_pytest(self, container, group, endpoint):
+        """
+        Run a pytest per batch of group concurrently against container.
+        Abort if the container dies or the timeout of a batch expires.
+        Profile radosgw if requested. Return pytest results of all tests
+        and per batch fields to add to results
+        """
+        host = await asyncio.to_thread(container.network_address)
+        profile = "profile" in container.hints
+        if profile:
+            await asyncio.to_thread(container.start_profile)
+        died = endpoint.watcher.watch(container.container, container.started_time_ns)
+        try:
+            # Died before it was watched
+            await asyncio.to_thread(container.container.reload)
+            if container.container.status != "running":
+                DeathWatcher.set_died(died, {"status": container.container.status})
+            runs = await asyncio.gather(
+                *(
+                    self.run_pytest_timed(host, container.port, names, died)
+                    for names in group
+                )
+            )
+        finally:
+            endpoint.watcher.unwatch(container.container)
+        pytest_results = {}
+        for batch_results, _ in runs:
+            pytest_results.update(batch_results)
+        fields = {}
+        if any(ret == "crash" for ret, *_ in pytest_results.values()):
+            log = await asyncio.to_thread(
+                container.logfile, None, CRASH_LOG_TAIL_BYTES, True
+            )
+            fields["crash_signature"] = classify.classify_log(log)["crash_signature"]
+            LOG.warning(
+                f"s3gw container {container.name} crashed: "
+                f"{fields['crash_signature']}"
+            )
+        elif profile:
+            folded = await asyncio.to_thread(container.stop_profile)
+            if folded:
+                fields["profile"] = await asyncio.to_thread(
+                    self.writer.write_blob,
+                    group[0][0].split("::")[-1],
+                    "profile",
+                    folded,
+                )
+        return pytest_results, [{**batch_fields, **fields} for _, batch_fields in runs]
+
+    async def scrape(self, container):
+        """Parsed metrics of a ready container. Baseline of a test run"""
+        return s3tr_metrics.parse(await asyncio.to_thread(container.metrics))
+
+    async def recycle(self, container):
+        await asyncio.to_thread(container.stop)
+        await asyncio.to_thread(container.remove)
+
+    async def prepare(self, group, endpoint):
+        """
+        Start a fresh container for the batches of group and provision
+        users. Return container, phase timer and ready_ns (None if
+        startup failed)
+        """
+        names = [name for names in group for name in names]
+        timer = PhaseTimer()
+        port = next(self.ports)
+        if len(names) == 1:
+            container_name = names[0].split("::")[1]
+        else:
+            container_name = f"batch_{port}"
+        container = self.make_container(
+            container_name,
+            port,
+            get_container_hints(names[0], self.disk_patterns, self.profile_patterns),
+            endpoint,
+        )
+        await asyncio.to_thread(container.start)
+        timer.mark("container_start")
+
+        ready_ns = await container.wait_ready()
+        timer.mark("ready")
+        if ready_ns is not None:
+            await asyncio.to_thread(container.provision)
+            timer.mark("users")
+        return container, timer, ready_ns
+
+    async def run_test(self, group, endpoint, prepared=None, before_teardown=None):
+        """
+        Run the batches of group in a fresh container. prepared is a task
+        of prepare() started ahead of time. before_teardown is called once
+        pytest finished, e.g to prestart the next container while this one
+        is torn down
+        """
+        names = [name for names in group for name in names]
+        container, timer, ready_ns = await (prepared or self.prepare(group, endpoint))
+        # Time a prestarted container waited for its worker
+        timer.mark("idle")
+        if ready_ns is None:
+            if before_teardown:
+                before_teardown()
+            logs = await self.logfile(container, names)
+            timer.mark("logs")
+            # Free the name for a retry or repeat of the same test
+            await self.recycle(container)
+            timer.mark("teardown")
+            return make_startup_failure_results(names, logs, timer)
+
+        baseline = await self.scrape(container)
+        stats_before = await asyncio.to_thread(container.cgroup_stats)
+        timer.mark("users")
+        pytest_results, pytest_fields = await self.run_pytest(
+            container, group, endpoint
+        )
+        timer.mark("pytest")
+        if before_teardown:
+            before_teardown()
+
+        stats_after = await asyncio.to_thread(container.cgroup_stats)
+        metrics = await asyncio.to_thread(container.metrics)
+        container_ret = await asyncio.to_thread(container.stop)
+        timer.mark("teardown")
+        logs = await self.logfile(container, names)
+        timer.mark("logs")
+        await asyncio.to_thread(container.remove)
+        timer.mark("teardown")
+        return make_results(
+            group,
+            pytest_results,
+            timer.elapsed_ns(),
+            {
+                "container_return": container_ret,
+                "container_logs": logs,
+                "metrics": metrics,
+                "metrics_delta": get_metrics_delta(baseline, metrics),
+                "ready_ns": ready_ns,
+                "phases_ns": timer.phases_ns,
+                **make_resource_fields(
+                    container,
+                    stats_before,
+                    stats_after,
+                    timer.phases_ns["pytest"],
+                ),
+            },
+            pytest_fields,
+        )
+
+    async def run_test_pooled(self, group, container, endpoint):
+        """
+        Like run_test(), but reuse the worker's container. Users are
+        provisioned once per container. Between batches the container
+        is restarted and /data restored to the state right after
+        provisioning. Containers are recycled after pool_recycle tests,
+        on crash or if a test needs a differently configured radosgw.
+
+        Return results and the container to use for the next batch.
+        Restarting a reused container is part of the ready phase.
+        """
+        names = [name for names in group for name in names]
+        timer = PhaseTimer()
+        hints = get_container_hints(names[0], self.disk_patterns, self.profile_patterns)
+        if container is not None and (
+            container.hints != hints or container.tests_run >= self.pool_recycle
+        ):
+            await self.recycle(container)
+            container = None
+            timer.mark("teardown")
+
+        if container is None:
+            port = next(self.ports)
+            container = self.make_container(f"pool_{port}", port, hints, endpoint)
+            await asyncio.to_thread(container.start)
+            timer.mark("container_start")
+            ready_ns = await container.wait_ready()
+            timer.mark("ready")
+            if ready_ns is not None:
+                await asyncio.to_thread(container.provision)
+                if not container.tmpfs_size and not container.golden:
+                    ready_ns = await container.snapshot()
+                timer.mark("users")
+        else:
+            ready_ns = await container.reset()
+            timer.mark("ready")
+            if ready_ns is not None and container.tmpfs_size:
+                # A tmpfs does not survive the restart. Without a golden
+                # copy there is nothing to restore
+                await asyncio.to_thread(container.provision)
+                timer.mark("users")
+
+        if ready_ns is None:
+            logs = await self.logfile(container, names)
+            timer.mark("logs")
+            await self.recycle(container)
+            timer.mark("teardown")
+            return make_startup_failure_results(names, logs, timer), None
+
+        baseline = await self.scrape(container)
+        stats_before = await asyncio.to_thread(container.cgroup_stats)
+        timer.mark("users")
+        pytest_results, pytest_fields = await self.run_pytest(
+            container, group, endpoint
+        )
+        timer.mark("pytest")
+
+        stats_after = await asyncio.to_thread(container.cgroup_stats)
+        resource_fields = make_resource_fields(
+            container, stats_before, stats_after, timer.phases_ns["pytest"]
+        )
+        metrics = await asyncio.to_thread(container.metrics)
+        container_ret = await asyncio.to_thread(container.stop)
+        timer.mark("teardown")
+        logs = await self.logfile(container, names)
+        timer.mark("logs")
+        container.tests_run += len(names)
+        if container_ret != "success":
+            await self.recycle(container)
+            container = None
+        timer.mark("teardown")
+        return (
+            make_results(
+                group,
+                pytest_results,
+                timer.elapsed_ns(),
+                {
+                    "container_return": container_ret,
+                    "container_logs": logs,
+                    "metrics": metrics,
+                    "metrics_delta": get_metrics_delta(baseline, metrics),
+                    "ready_ns": ready_ns,
+                    "phases_ns": timer.phases_ns,
+                    **resource_fields,
+                },
+                pytest_fields,
+            ),
+            container,
+        )
+
+
+async def run_tests(runner, batches):
+    # Docker API calls run in the default executor. Size it to allow a
+    # few blocking calls per worker
+    loop = asyncio.get_running_loop()
+    loop.set_default_executor(
+        concurrent.futures.ThreadPoolExecutor(
+            max_workers=THREADS_PER_WORKER * runner.nproc
+        )
+    )
+    return await runner.run(batches)
+
+
+def get_image_id(cri, image):
+    try:
+        return cri.images.get(image).id
+    except docker.errors.ImageNotFound:
+        LOG.info(f"Pulling {image}")
+        return cri.images.pull(image).id
 
 
 def cleanup(cri):
@@ -451,10 +1927,16 @@ class JSONParamType(click.ParamType):
 @click.command()
 @click.option(
     "--docker-api",
+    "docker_apis",
     type=str,
     envvar="DOCKER_API",
-    default="unix:///var/run/docker.sock",
-    help="Docker API URI. e.g unix://run/podman/podman.sock",
+    multiple=True,
+    default=("unix:///var/run/docker.sock",),
+    help=(
+        "Docker API URI. e.g unix://run/podman/podman.sock. May be repeated "
+        "to spread tests across endpoints. Containers of tcp:// and ssh:// "
+        "endpoints are reached via published ports on the endpoint's host"
+    ),
 )
 @click.option(
     "--tests",
@@ -466,7 +1948,28 @@ class JSONParamType(click.ParamType):
     "--nproc",
     type=int,
     default=42,
-    help="processing pool size",
+    help=(
+        "number of concurrent workers. Split across --docker-api endpoints "
+        "by their CPU count"
+    ),
+)
+@click.option(
+    "--pool-recycle",
+    type=int,
+    default=0,
+    help=(
+        "> 0 reuse a warm container per worker for this many tests, "
+        "resetting /data between tests. 0 starts a fresh container per test"
+    ),
+)
+@click.option(
+    "--batch-size",
+    type=int,
+    default=1,
+    help=(
+        "> 1 run up to this many tests of the same module in one pytest "
+        "process against one container"
+    ),
 )
 @click.option(
     "--sample",
@@ -496,48 +1999,306 @@ class JSONParamType(click.ParamType):
     type=JSONParamType(),
     default="{}",
 )
-@click.argument("output", type=click.File("w"))
+@click.option(
+    "--log-max-bytes",
+    type=int,
+    default=0,
+    help="> 0 keep at most this many bytes of each container log",
+)
+@click.option(
+    "--log-tail/--log-head",
+    default=False,
+    help="With --log-max-bytes keep the end instead of the start of logs",
+)
+@click.option(
+    "--history",
+    "history_paths",
+    multiple=True,
+    type=click.Path(
+        exists=True,
+        file_okay=True,
+        dir_okay=False,
+        allow_dash=False,
+        path_type=pathlib.Path,
+    ),
+    help=(
+        "Results file or to-sqlite database of a previous run. Tests are "
+        "scheduled longest first using their runtimes. May be repeated"
+    ),
+)
+@click.option(
+    "--timeout-multiplier",
+    type=float,
+    default=TIMEOUT_MULTIPLIER,
+    show_default=True,
+    help=(
+        "With --history, time out tests after this multiple of their p99 "
+        f"runtime, at least {TIMEOUT_FLOOR_SEC}s and at most "
+        f"{TIMEOUT_CEILING_SEC}s. Tests without history and 0 use "
+        f"{PYTEST_TIMEOUT_SEC}s"
+    ),
+)
+@click.option(
+    "--metrics-port",
+    type=int,
+    default=0,
+    help=(
+        "> 0 serve Prometheus metrics of the run, e.g tests by result, "
+        "phase latencies and estimated time left, on this port"
+    ),
+)
+@click.option(
+    "--resume/--no-resume",
+    default=False,
+    help=(
+        "Skip tests already recorded in OUTPUT, e.g of an interrupted run, "
+        "and append to it. By default OUTPUT is overwritten"
+    ),
+)
+@click.option(
+    "--tmpfs-size",
+    type=str,
+    default=None,
+    help=(
+        "Mount a tmpfs of this size, e.g 512m, at /data of each container "
+        "instead of using the container's disk"
+    ),
+)
+@click.option(
+    "--disk-tests",
+    multiple=True,
+    default=DISK_TEST_PATTERNS,
+    show_default=True,
+    help=(
+        "With --tmpfs-size run tests with names containing this string "
+        "with /data on disk. May be repeated"
+    ),
+)
+@click.option(
+    "--prestart/--no-prestart",
+    default=True,
+    help=(
+        "Without --pool-recycle, boot the container of a worker's next "
+        "test while the current container is torn down"
+    ),
+)
+@click.option(
+    "--profile",
+    "profile_patterns",
+    multiple=True,
+    help=(
+        "Sample radosgw with perf record while tests with names containing "
+        "this string run. perf must be in the image or mounted with "
+        "--extra-container-args. May be repeated"
+    ),
+)
+@click.option(
+    "--cache",
+    "cache_path",
+    type=click.Path(
+        file_okay=False, dir_okay=True, allow_dash=False, path_type=pathlib.Path
+    ),
+    help=(
+        "Directory of cached successful results. Tests with a cached result "
+        "for the same image, test files and radosgw configuration are not run"
+    ),
+)
+@click.option(
+    "--force",
+    is_flag=True,
+    default=False,
+    help="With --cache run all tests. Results are still cached",
+)
+@click.option(
+    "--shared",
+    type=click.IntRange(min=1),
+    default=1,
+    help=(
+        "> 1 run up to this many pytest processes, each with a batch of "
+        "tests, concurrently against one container"
+    ),
+)
+@click.option(
+    "--golden-data/--no-golden-data",
+    default=True,
+    help=(
+        "Create users once in a golden container and start all other "
+        "containers with a copy of its /data"
+    ),
+)
+@click.option(
+    "--debug-rgw",
+    type=click.IntRange(min=0, max=20),
+    default=FULL_DEBUG_RGW,
+    show_default=True,
+    help=(
+        f"radosgw debug level. Below {FULL_DEBUG_RGW}, tests that did not "
+        f"succeed are rerun at {FULL_DEBUG_RGW} for full logs"
+    ),
+)
+@click.option(
+    "--debug-rerun/--no-debug-rerun",
+    default=True,
+    help="With --debug-rgw below 10, rerun tests that did not succeed",
+)
+@click.option(
+    "--retries",
+    type=click.IntRange(min=0),
+    default=0,
+    help=(
+        "Retry tests that did not succeed alone in a fresh container up to "
+        "this many times. Tests that succeed on retry are marked flaky"
+    ),
+)
+@click.option(
+    "--repeat",
+    type=click.IntRange(min=1),
+    default=1,
+    help=(
+        "Run each test this many times and record runtime and phase "
+        "timings of every run. See analyze benchmark"
+    ),
+)
+@click.argument(
+    "output",
+    type=click.Path(
+        file_okay=True, dir_okay=False, allow_dash=False, path_type=pathlib.Path
+    ),
+)
 def run(
-    docker_api, tests, nproc, sample, image, s3_tests, output, extra_container_args
+    docker_apis,
+    tests,
+    nproc,
+    pool_recycle,
+    batch_size,
+    sample,
+    image,
+    s3_tests,
+    output,
+    extra_container_args,
+    log_max_bytes,
+    log_tail,
+    history_paths,
+    timeout_multiplier,
+    metrics_port,
+    resume,
+    repeat,
+    tmpfs_size,
+    disk_tests,
+    prestart,
+    profile_patterns,
+    cache_path,
+    force,
+    shared,
+    golden_data,
+    debug_rgw,
+    debug_rerun,
+    retries,
 ):
     """
     Run all or selected (--tests) s3tests against s3gw container image (--image)
-    using a Docker compatible API endpoint (--docker-api).
+    using Docker compatible API endpoints (--docker-api).
+
+    Results are streamed to OUTPUT as JSON Lines, one line per test.
     """
-    if (
-        docker_api.startswith("unix")
-        and not pathlib.Path(docker_api[len("unix:") :]).exists()
-    ):
-        LOG.critical(
-            f"Docker API set to unix socket ({docker_api}), "
-            "but file does not exist. Add docker volume?"
-        )
-        sys.exit(2)
+    for docker_api in docker_apis:
+        if (
+            docker_api.startswith("unix")
+            and not pathlib.Path(docker_api[len("unix:") :]).exists()
+        ):
+            LOG.critical(
+                f"Docker API set to unix socket ({docker_api}), "
+                "but file does not exist. Add docker volume?"
+            )
+            sys.exit(2)
 
     tests = get_tests(s3_tests, tests)
     if sample > 0:
         tests = random.sample(tests, sample)
+    if resume:
+        if output.exists():
+            with open(output) as fp:
+                if s3tr_results.is_json_array(fp):
+                    LOG.critical(
+                        f"Can't resume {output}, a JSON array from an older s3tr"
+                    )
+                    sys.exit(2)
+        recorded = s3tr_results.recorded_tests(output)
+        if recorded:
+            LOG.info(f"Resuming. Skipping {len(recorded)} tests recorded in {output}")
+            tests = [test for test in tests if test not in recorded]
     LOG.debug(f"Running {len(tests)} tests: {tests}")
     LOG.info(
         f"Running {nproc} tests in parallel against "
         f"image {image} "
-        f"with docker API {docker_api} "
+        f"with docker API {', '.join(docker_apis)} "
         f"with s3-tests in {s3_tests}"
     )
     LOG.info(
         'Running radosgw with command "%s"',
-        " ".join(make_radosgw_command("PLACEHOLDER", -1, True)),
+        " ".join(make_radosgw_command("PLACEHOLDER", -1, True, debug_rgw)),
     )
+    disk_patterns = tuple(disk_tests) if tmpfs_size else ()
+    endpoints = make_endpoints(docker_apis, nproc)
+    run_metrics = RunMetrics()
+    if metrics_port > 0:
+        run_metrics.serve(metrics_port)
     try:
-        results = run_tests(
-            docker_api, image, extra_container_args, s3_tests, nproc, tests
-        )
-        LOG.info(f"Done. Ran {len(results)} tests.")
-        json.dump(results, output)
-        output.flush()
-        LOG.info(f"Writing results to {output}")
+        cache = None
+        if cache_path:
+            cache = ResultCache(
+                cache_path,
+                s3_tests,
+                get_image_id(endpoints[0].cri, image),
+                extra_container_args,
+            )
+        with s3tr_results.ResultWriter(output, truncate=not resume) as writer:
+            LOG.info(f"Writing results to {output}")
+            runner = Runner(
+                endpoints,
+                image,
+                extra_container_args,
+                s3_tests,
+                pool_recycle,
+                writer,
+                log_max_bytes,
+                log_tail,
+                History(history_paths),
+                repeat,
+                tmpfs_size,
+                disk_patterns,
+                prestart,
+                profile_patterns,
+                cache,
+                timeout_multiplier,
+                run_metrics,
+                shared,
+                golden_data,
+                debug_rgw,
+                retries,
+            )
+            if runner.cache and not force:
+                tests = runner.reuse_cached(tests)
+            batches = get_batches(tests, batch_size, disk_patterns, profile_patterns)
+            count = asyncio.run(run_tests(runner, batches))
+            LOG.info(f"Done. Ran {count} tests.")
+            if debug_rgw < FULL_DEBUG_RGW and debug_rerun:
+                reruns = get_debug_reruns(output)
+                LOG.info(
+                    f"Rerunning {len(reruns)} tests that did not succeed "
+                    f"with --debug-rgw {FULL_DEBUG_RGW}"
+                )
+                runner.debug_rgw = FULL_DEBUG_RGW
+                runner.repeat = 1
+                batches = get_batches(
+                    reruns, batch_size, disk_patterns, profile_patterns
+                )
+                count = asyncio.run(run_tests(runner, batches))
+                LOG.info(f"Done. Reran {count} tests.")
+        s3tr_results.compact(output, merge_debug_reruns)
     finally:
-        cleanup(docker.DockerClient(base_url=docker_api))
+        for endpoint in endpoints:
+            cleanup(endpoint.cri)
 
 
 if __name__ == "__main__":
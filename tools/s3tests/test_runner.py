@@ -0,0 +1,252 @@
+#!/usr/bin/env python3
+"""
+Regression tests of the runner's container handling against a fake
+Docker API. Run with pytest from this directory
+"""
+
+import asyncio
+import io
+import tarfile
+import types
+
+import docker
+import pytest
+import results as s3tr_results
+import runner
+
+TEST = "s3tests_boto3/functional/test_s3.py::test_bucket_list_empty"
+
+
+class FakeContainer:
+    """A container that exits right after start, like a broken radosgw"""
+
+    def __init__(self, containers, name):
+        self.containers = containers
+        self.name = name
+        self.id = f"id_{name}"
+        self.status = "running"
+        self.attrs = {
+            "NetworkSettings": {"IPAddress": ""},
+            "State": {"StartedAt": "2024-05-02T10:00:00.123456789Z"},
+        }
+
+    def reload(self):
+        self.status = "exited"
+
+    def stop(self, timeout=None):
+        self.status = "exited"
+
+    def remove(self):
+        del self.containers.by_name[self.name]
+
+    def get_archive(self, path):
+        raise docker.errors.NotFound(f"{path} not found")
+
+    def put_archive(self, path, data):
+        pass
+
+    def start(self):
+        self.status = "running"
+
+
+class FakeImages:
+    def __init__(self):
+        self.pulled = set()
+
+    def pull(self, image):
+        self.pulled.add(image)
+
+
+class FakeContainers:
+    def __init__(self, images):
+        self.images = images
+        self.by_name = {}
+
+    def create(self, image, name, **kwargs):
+        if image not in self.images.pulled:
+            raise docker.errors.ImageNotFound(f"No such image: {image}")
+        if name in self.by_name:
+            raise docker.errors.APIError(f"Conflict. {name} is already in use")
+        self.by_name[name] = FakeContainer(self, name)
+        return self.by_name[name]
+
+    def run(self, image, name, **kwargs):
+        self.images.pull(image)
+        return self.create(image, name, **kwargs)
+
+
+@pytest.fixture
+def endpoint():
+    images = FakeImages()
+    return types.SimpleNamespace(
+        docker_api="fake",
+        cri=types.SimpleNamespace(images=images, containers=FakeContainers(images)),
+        publish_host=None,
+        watcher=None,
+        nproc=1,
+    )
+
+
+@pytest.mark.parametrize(
+    "kwargs",
+    [{"retries": 1}, {"repeat": 2}, {"repeat": 2, "retries": 1}],
+)
+def test_startup_failure_removes_container(tmp_path, endpoint, kwargs):
+    """
+    A container that never got ready is removed, so that a retry or
+    repeat of the same test can reuse its name
+    """
+    with s3tr_results.ResultWriter(tmp_path / "results.json") as writer:
+        test_runner = runner.Runner(
+            [endpoint], "s3gw", {}, tmp_path, 0, writer, **kwargs
+        )
+        test_runner.pending = {TEST}
+        test_runner.total = 1
+        queue = asyncio.Queue()
+        queue.put_nowait([[TEST]])
+        asyncio.run(test_runner.worker(queue, endpoint))
+
+    assert endpoint.cri.containers.by_name == {}
+    (result,) = s3tr_results.read_results(tmp_path / "results.json")
+    assert result["test"] == TEST
+    assert result["ready_ns"] is None
+
+
+def test_golden_start_pulls_image(endpoint):
+    container = runner.S3GW(
+        endpoint.cri, "s3gw", {}, "golden_test", 7480, frozenset(), golden=b"tar"
+    )
+    container.start()
+    assert endpoint.cri.images.pulled == {"s3gw"}
+    assert "s3gw_golden_test" in endpoint.cri.containers.by_name
+
+
+def test_make_golden_falls_back(tmp_path, endpoint, monkeypatch):
+    """Without a golden copy every container provisions its users"""
+
+    def create_user(self, **kwargs):
+        raise ConnectionError("admin API unreachable")
+
+    monkeypatch.setattr(runner.S3GW, "http_up", lambda self: True)
+    monkeypatch.setattr(runner.S3GW, "create_user", create_user)
+    with s3tr_results.ResultWriter(tmp_path / "results.json") as writer:
+        test_runner = runner.Runner([endpoint], "s3gw", {}, tmp_path, 0, writer)
+        assert asyncio.run(test_runner.make_golden(endpoint)) is None
+    assert endpoint.cri.containers.by_name == {}
+
+
+class FakeEvents:
+    def __init__(self, events):
+        self.events = events
+
+    def __iter__(self):
+        return iter(self.events)
+
+    def close(self):
+        pass
+
+
+def test_death_watcher_ignores_events_before_start():
+    """A reused container's previous stop is no crash of the next test"""
+    container = types.SimpleNamespace(id="id_pool_10000")
+
+    async def watch(event):
+        cri = types.SimpleNamespace(events=lambda **kwargs: FakeEvents([]))
+        watcher = runner.DeathWatcher(cri, asyncio.get_running_loop())
+        died = watcher.watch(container, since_ns=2000)
+        watcher.events = FakeEvents([event])
+        watcher.follow()
+        await asyncio.sleep(0)
+        return died.done()
+
+    assert not asyncio.run(watch({"id": container.id, "timeNano": 1000}))
+    assert asyncio.run(watch({"id": container.id, "timeNano": 3000}))
+
+
+def test_parse_cgroup_stats_without_io_stat():
+    stats = runner.parse_cgroup_stats("== cpu.stat\nusage_usec 7\nuser_usec 5\n")
+    assert stats == {"cpu_usec": 7}
+    stats = runner.parse_cgroup_stats("== io.stat\n8:0 rbytes=1 wbytes=2 rios=1\n")
+    assert stats == {"io_rbytes": 1, "io_wbytes": 2}
+
+
+def test_logfile_head_cap_flushes_before_marker():
+    log = "ä" * 3
+    buf = io.BytesIO()
+    with tarfile.open(fileobj=buf, mode="w") as tf:
+        info = tarfile.TarInfo("log")
+        info.size = len(log.encode())
+        tf.addfile(info, io.BytesIO(log.encode()))
+    container = runner.S3GW(None, "s3gw", {}, "log_test", 7480, frozenset())
+    container.container = types.SimpleNamespace(
+        get_archive=lambda path: ((chunk for chunk in [buf.getvalue()]), {})
+    )
+    assert container.logfile(max_bytes=3) == "ä�\n[s3tr: skipped last 3 bytes]"
+
+
+def test_get_killed_test():
+    stdout = b"collected 2 items\n\nt.py::test_a PASSED\nt.py::test_b "
+    read_ns = [(20, 100), (40, 200), (len(stdout), 300)]
+    assert runner.get_killed_test(stdout, read_ns, 1000) == ("t.py::test_b", 800)
+    assert runner.get_killed_test(b"t.py::test_a PASSED\n", read_ns, 1000) is None
+
+
+def test_parse_cgroup_stats_rss_peak():
+    stats = runner.parse_cgroup_stats(
+        "== radosgw.status\nName:\tradosgw\nVmHWM:\t  2048 kB\nVmRSS:\t  1024 kB\n"
+    )
+    assert stats == {"rss_peak": 2048 * 1024}
+
+
+@pytest.mark.parametrize(
+    "timestamp",
+    [
+        "2024-05-02T10:00:00.123456789Z",
+        "2024-05-02T12:00:00.123456789+02:00",
+        "2024-05-02T05:30:00.123456789-04:30",
+    ],
+)
+def test_parse_docker_time_ns_offsets(timestamp):
+    assert runner.parse_docker_time_ns(timestamp) == 1714644000123456789
+
+
+def test_run_without_batches_starts_nothing(tmp_path, endpoint):
+    with s3tr_results.ResultWriter(tmp_path / "results.json") as writer:
+        test_runner = runner.Runner(
+            [endpoint], "s3gw", {}, tmp_path, 0, writer, golden_data=True
+        )
+        assert asyncio.run(test_runner.run([])) == 0
+    assert endpoint.cri.images.pulled == set()
+
+
+def test_failed_golden_is_not_retried(tmp_path, endpoint, monkeypatch):
+    attempts = []
+
+    async def make_golden(self, endpoint):
+        attempts.append(endpoint)
+        return None
+
+    monkeypatch.setattr(runner.Runner, "make_golden", make_golden)
+    monkeypatch.setattr(
+        runner,
+        "DeathWatcher",
+        lambda cri, loop: types.SimpleNamespace(close=lambda: None),
+    )
+    with s3tr_results.ResultWriter(tmp_path / "results.json") as writer:
+        test_runner = runner.Runner(
+            [endpoint], "s3gw", {}, tmp_path, 0, writer, golden_data=True
+        )
+        for _ in range(2):
+            asyncio.run(test_runner.run([[TEST]]))
+    assert len(attempts) == 1
+
+
+def test_merge_debug_reruns_keeps_full_log_of_successful_rerun():
+    first = {"test": TEST, "test_return": "fail", "container_logs": "short"}
+    rerun = {"test": TEST, "test_return": "success", "container_logs": "full"}
+    result = runner.merge_debug_reruns(
+        [first | {"debug_rgw": 1}, rerun | {"debug_rgw": 10}]
+    )
+    assert result["test_return"] == "fail"
+    assert result["container_logs"] == "full"
+    assert result["debug_rgw"] == 10
@@ -4,13 +4,19 @@ Convert s3gw s3 tests runner JSON results
 to an SQLite database suitable to Datasette
 """
 
+import collections
 import configparser
-import json
+import itertools
 import logging
+import multiprocessing
 import pathlib
 import tempfile
+import time
 
+import classify
 import click
+import results as s3tr_results
+import runner
 import sqlite_utils
 import uvicorn
 import yaml
@@ -18,20 +24,47 @@ from datasette.app import Datasette
 
 LOG = logging.getLogger("s3tr")
 
+# Results per insert_all() batch
+INSERT_BATCH_SIZE = 100
 
-def get_test_result(result):
-    ret = result["test_return"]
-    logs = result["container_logs"]
-    if "Segmentation fault" in logs:
-        return f"{ret}+segfault"
-    if "FAILED ceph_assert" in logs:
-        return f"{ret}+assertion"
-    elif "BUG Unhandled exception" in logs:
-        return f"{ret}+unhandled exception"
-    elif "end dump of recent events" in logs:
-        return f"{ret}+crash"
+# Resource usage keys of results stored as columns
+RESOURCE_KEYS = ("cpu_ns", "mem_peak_bytes", "io_read_bytes", "io_write_bytes")
 
-    return ret
+# Batches of results converted by the process pool ahead of the
+# inserts. Bounds memory if converting is faster than inserting
+PENDING_BATCHES = 2
+
+# SQLite page cache size during conversion
+SQLITE_CACHE_KIB = 256 * 1024
+
+
+def chunks(iterable, size):
+    iterator = iter(iterable)
+    while chunk := list(itertools.islice(iterator, size)):
+        yield chunk
+
+
+def imap_bounded(pool, func, iterable, size):
+    """
+    Like pool.imap(), but with at most PENDING_BATCHES chunks of size
+    items converted ahead of the consumer. imap() keeps every result
+    the consumer did not take yet
+    """
+    pending = collections.deque()
+    for chunk in chunks(iterable, size):
+        pending.append(pool.map_async(func, chunk, chunksize=4))
+        if len(pending) > PENDING_BATCHES:
+            yield from pending.popleft().get()
+    while pending:
+        yield from pending.popleft().get()
+
+
+def get_test_result(result, classification=None):
+    if classification is None:
+        classification = classify.classify_log(result["container_logs"])
+    if classification["crash"]:
+        return f"{result['test_return']}+{classification['crash']}"
+    return result["test_return"]
 
 
 def get_keywords(result, markers):
@@ -41,27 +74,166 @@ def get_keywords(result, markers):
         return set()
 
 
-def make_full_results_database(results, pytest_markers, db_path):
+def make_attempt_rows(test, result, **fields):
+    return [
+        {"test": test, "attempt": attempt, "result": test_return, **fields}
+        for attempt, test_return in enumerate(s3tr_results.get_attempt_returns(result))
+    ]
+
+
+def create_flakiness_view(db, name, attempts_table):
+    """
+    Per test attempts, failed attempts and flakiness: 0 if all attempts
+    had the same outcome, 1 if a test succeeded as often as it failed
+    """
+    db.create_view(
+        name,
+        f"""
+       select
+         test,
+         count(*) as attempts,
+         sum(result != 'success') as failed,
+         2.0 * min(sum(result = 'success'), sum(result != 'success')) / count(*)
+           as flakiness
+       from {attempts_table}
+       group by test
+    """,
+        ignore=True,
+    )
+
+
+def tune_for_bulk_insert(db):
+    """
+    Trade durability for insert speed. A failed conversion is simply
+    repeated
+    """
+    db.execute("PRAGMA journal_mode = MEMORY")
+    db.execute("PRAGMA synchronous = OFF")
+    db.execute("PRAGMA temp_store = MEMORY")
+    db.execute(f"PRAGMA cache_size = -{SQLITE_CACHE_KIB}")
+
+
+def make_result_row(task):
+    """
+    Make results row, keywords, metric deltas and attempt rows of a
+    result. Runs in a worker process, side files are loaded there
+    """
+    path, result, markers = task
+    s3tr_results.load_blobs(path, result)
+    classification = classify.classify_log(result["container_logs"])
+    row = {
+        "test": result["test"].split("::")[1],
+        "result": get_test_result(result, classification),
+        "out": result["test_output"],
+        "log_container": result["container_logs"],
+        "metrics": result.get("metrics", ""),
+        "runtime_ns": result.get("runtime_ns"),
+        "pytest_ns": result.get("pytest_ns"),
+        **{key: result.get(key) for key in RESOURCE_KEYS},
+        "flaky": result.get("flaky"),
+        **classification,
+    }
+    metrics = result.get("metrics_delta", {})
+    attempts = make_attempt_rows(row["test"], result)
+    return row, get_keywords(result, markers), metrics, attempts
+
+
+def make_full_results_database(results_path, pytest_markers, db_path, processes=None):
+    """
+    Stream results from results_path and insert them in batches within
+    one transaction. Logs are loaded and classified in a pool of
+    processes. Indexes and the full text search index are built once
+    at the end
+    """
+    start_ns = time.perf_counter_ns()
     db = sqlite_utils.Database(db_path)
-    for i, result in enumerate(results):
-        keywords = get_keywords(result, pytest_markers)
-        row = {
-            "test": result["test"].split("::")[1],
-            "result": get_test_result(result),
-            "out": result["test_output"],
-            "log_container": result["container_logs"],
-            "metrics": result["metrics"],
-        }
-        db["results"].insert(row, pk="test")
-        for keyword in keywords:
-            db["results_keywords"].insert(
-                {"test": row["test"], "keyword": keyword},
-                foreign_keys=[("test", "results", "test")],
-                pk="id",
-            )
+    tune_for_bulk_insert(db)
+    db["results"].create(
+        {
+            "test": str,
+            "result": str,
+            "out": str,
+            "log_container": str,
+            "metrics": str,
+            "runtime_ns": int,
+            "pytest_ns": int,
+            **{key: int for key in RESOURCE_KEYS},
+            "flaky": bool,
+            "crash": str,
+            "crash_signature": str,
+            "crash_frame": str,
+            "assert_location": str,
+            "assert_condition": str,
+            "exception": str,
+        },
+        pk="test",
+        if_not_exists=True,
+    )
+    db["results_keywords"].create(
+        {"id": int, "test": str, "keyword": str},
+        pk="id",
+        foreign_keys=[("test", "results", "test")],
+        if_not_exists=True,
+    )
+    db["results_metrics"].create(
+        {"id": int, "test": str, "series": str, "metric": str, "value": float},
+        pk="id",
+        foreign_keys=[("test", "results", "test")],
+        if_not_exists=True,
+    )
+    db["results_attempts"].create(
+        {"id": int, "test": str, "attempt": int, "result": str},
+        pk="id",
+        foreign_keys=[("test", "results", "test")],
+        if_not_exists=True,
+    )
 
-        if (i % 50) == 0:
-            LOG.info(f"{i}/{len(results)} done")
+    count = 0
+    text_bytes = 0
+    tasks = (
+        (results_path, result, pytest_markers)
+        for result in s3tr_results.read_merged_results(
+            results_path, runner.merge_debug_reruns, blobs=False
+        )
+    )
+    with multiprocessing.Pool(processes) as pool, db.atomic():
+        rows_and_keywords = imap_bounded(
+            pool, make_result_row, tasks, INSERT_BATCH_SIZE
+        )
+        for chunk in chunks(rows_and_keywords, INSERT_BATCH_SIZE):
+            rows = [row for row, _, _, _ in chunk]
+            db["results"].insert_all(rows, batch_size=INSERT_BATCH_SIZE)
+            db["results_keywords"].insert_all(
+                (
+                    {"test": row["test"], "keyword": keyword}
+                    for row, keywords, _, _ in chunk
+                    for keyword in keywords
+                ),
+                batch_size=INSERT_BATCH_SIZE,
+            )
+            db["results_metrics"].insert_all(
+                (
+                    {
+                        "test": row["test"],
+                        "series": series,
+                        "metric": series.split("{")[0],
+                        "value": value,
+                    }
+                    for row, _, metrics, _ in chunk
+                    for series, value in metrics.items()
+                ),
+                batch_size=INSERT_BATCH_SIZE,
+            )
+            db["results_attempts"].insert_all(
+                (attempt for _, _, _, attempts in chunk for attempt in attempts),
+                batch_size=INSERT_BATCH_SIZE,
+            )
+            count += len(rows)
+            text_bytes += sum(
+                len(row["out"]) + len(row["log_container"]) + len(row["metrics"])
+                for row in rows
+            )
+            LOG.info(f"{count} results inserted")
 
     db.create_view(
         "results_with_keywords",
@@ -73,11 +245,42 @@ def make_full_results_database(results, pytest_markers, db_path):
        on results.test = results_keywords.test
        group by results.test
     """,
+        ignore=True,
     )
     db["results"].enable_fts(["out", "log_container", "metrics"])
-    db["results"].create_index(["result"])
-    db["results_keywords"].create_index(["keyword"])
-    db["results_keywords"].create_index(["test"])
+    db["results"].create_index(["result"], if_not_exists=True)
+    db["results"].create_index(["crash_signature"], if_not_exists=True)
+    db["results_keywords"].create_index(["keyword"], if_not_exists=True)
+    db["results_keywords"].create_index(["test"], if_not_exists=True)
+    db["results_metrics"].create_index(["metric"], if_not_exists=True)
+    db["results_metrics"].create_index(["test"], if_not_exists=True)
+    db["results_attempts"].create_index(["test"], if_not_exists=True)
+    create_flakiness_view(db, "results_flakiness", "results_attempts")
+
+    runtime_s = (time.perf_counter_ns() - start_ns) / 10**9
+    LOG.info(
+        f"Converted {count} results ({text_bytes / 2**20:.1f} MiB text) "
+        f"in {runtime_s:.1f}s. "
+        f"{count / runtime_s:.1f} results/s, "
+        f"{text_bytes / 2**20 / runtime_s:.1f} MiB/s"
+    )
+
+
+def make_comparison_rows(results, version_id, attempts):
+    """Results rows of a version. Adds their attempt rows to attempts"""
+    for result in results:
+        test = result["test"].split("::")[1]
+        classification = classify.classify_log(result["container_logs"])
+        attempts.extend(make_attempt_rows(test, result, version_id=version_id))
+        yield {
+            "test": test,
+            "result": get_test_result(result, classification),
+            "crash_signature": classification["crash_signature"],
+            "runtime_ns": result.get("runtime_ns"),
+            "pytest_ns": result.get("pytest_ns"),
+            **{key: result.get(key) for key in RESOURCE_KEYS},
+            "version_id": version_id,
+        }
 
 
 def make_comparison_database(results_by_versions, db_path):
@@ -89,17 +292,57 @@ def make_comparison_database(results_by_versions, db_path):
         ],
         pk="id",
     )
-    for (_, index), results in results_by_versions.items():
-        for result in results:
-            db["results"].insert(
-                {
-                    "test": result["test"].split("::")[1],
-                    "result": get_test_result(result),
-                    "version_id": index,
-                },
-                pk="id",
-                foreign_keys=("version_id", "versions"),
+    tune_for_bulk_insert(db)
+    db["results"].create(
+        {
+            "id": int,
+            "test": str,
+            "result": str,
+            "crash_signature": str,
+            "runtime_ns": int,
+            "pytest_ns": int,
+            **{key: int for key in RESOURCE_KEYS},
+            "version_id": int,
+        },
+        pk="id",
+        foreign_keys=[("version_id", "versions")],
+        if_not_exists=True,
+    )
+    db["attempts"].create(
+        {"id": int, "test": str, "attempt": int, "result": str, "version_id": int},
+        pk="id",
+        foreign_keys=[("version_id", "versions")],
+        if_not_exists=True,
+    )
+    with db.atomic():
+        for (_, index), results in results_by_versions.items():
+            attempts = []
+            db["results"].insert_all(
+                make_comparison_rows(results, index, attempts),
+                batch_size=INSERT_BATCH_SIZE,
             )
+            db["attempts"].insert_all(attempts, batch_size=INSERT_BATCH_SIZE)
+    db["results"].create_index(["test"], if_not_exists=True)
+    db["attempts"].create_index(["test"], if_not_exists=True)
+    create_flakiness_view(db, "flakiness", "attempts")
+    db.create_view(
+        "resource_changes",
+        """
+       select
+         changed.test,
+         versions.name as version,
+         1.0 * changed.cpu_ns / base.cpu_ns as cpu_ratio,
+         1.0 * changed.mem_peak_bytes / base.mem_peak_bytes as mem_peak_ratio,
+         1.0 * changed.io_write_bytes / base.io_write_bytes as io_write_ratio,
+         changed.cpu_ns, changed.mem_peak_bytes, changed.io_write_bytes
+       from results as base
+       inner join results as changed
+       on base.test = changed.test and changed.version_id != base.version_id
+       inner join versions on versions.id = changed.version_id
+       where base.version_id = 0
+    """,
+        ignore=True,
+    )
 
 
 @click.group()
@@ -127,6 +370,12 @@ def datasette():
     ),
     required=True,
 )
+@click.option(
+    "--processes",
+    type=int,
+    default=None,
+    help="Number of processes classifying logs. Defaults to the CPU count",
+)
 @click.argument(
     "db_path",
     type=click.Path(
@@ -134,17 +383,21 @@ def datasette():
     ),
     required=True,
 )
-@click.argument("input", type=click.File("r"))
-def convert(pytest_ini, db_path, input):
+@click.argument(
+    "input",
+    type=click.Path(
+        file_okay=True, dir_okay=False, allow_dash=False, path_type=pathlib.Path
+    ),
+)
+def convert(pytest_ini, processes, db_path, input):
     """
     Create sqlite database with full logs and test output from a
     single testrun JSON file
     """
-    results = json.load(input)
     ini_parser = configparser.ConfigParser()
     ini_parser.read(pytest_ini)
     markers = frozenset(ini_parser["pytest"]["markers"].split())
-    make_full_results_database(results, markers, db_path)
+    make_full_results_database(input, markers, db_path, processes)
 
 
 @datasette.command()
@@ -164,12 +417,16 @@ def convert(pytest_ini, db_path, input):
     ),
     required=True,
 )
-@click.argument("input", type=click.File("r"))
+@click.argument(
+    "input",
+    type=click.Path(
+        file_okay=True, dir_okay=False, allow_dash=False, path_type=pathlib.Path
+    ),
+)
 def serve(pytest_ini, datasette_metadata, input):
     """
     Open full results for a single run in datasette
     """
-    results = json.load(input)
     ini_parser = configparser.ConfigParser()
     ini_parser.read(pytest_ini)
     markers = frozenset(ini_parser["pytest"]["markers"].split())
@@ -180,7 +437,7 @@ def serve(pytest_ini, datasette_metadata, input):
         pathlib.Path(tmpdir) / "results.db", "w"
     ) as db_file:
         LOG.info(f"Converting {input} to SQLite {db_file.name}")
-        make_full_results_database(results, markers, db_file.name)
+        make_full_results_database(input, markers, db_file.name)
 
         ds = Datasette(files=[db_file.name], metadata=metadata)
         LOG.info(f"Starting datasette {ds}")
@@ -217,9 +474,9 @@ def comparison(pytest_ini, db_path, input_files):
     """
     results_by_versions = {}
     for i, file in enumerate(input_files):
-        with open(file) as fp:
-            results = json.load(fp)
-        results_by_versions[(file.name, i)] = results
+        results_by_versions[(file.name, i)] = s3tr_results.read_merged_results(
+            file, runner.merge_debug_reruns
+        )
 
     make_comparison_database(results_by_versions, db_path)
 